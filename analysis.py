@@ -0,0 +1,101 @@
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+CONTACT_HEADERS = ["phone", "email", "first name", "last name"]
+ID_HEADERS = ["contact id", "location id"]
+FRAME_HEADERS = CONTACT_HEADERS + ID_HEADERS
+REPORT_COLUMNS = ["location id", "lds link", "row", "first name", "last name"]
+
+
+def missing_headers(worksheet_values):
+    """FRAME_HEADERS that are not in the header row of a worksheet snapshot"""
+    headers = {header.lower().rstrip() for header in worksheet_values[0]} if worksheet_values else set()
+    return [header for header in FRAME_HEADERS if header not in headers]
+
+
+def _project_columns(worksheet_values):
+    """returns {header: object array of the column} for FRAME_HEADERS from the data rows of a worksheet snapshot"""
+    # like the headers_mapping dicts, the last column wins when a header appears twice
+    positions = {header.lower().rstrip(): index for index, header in enumerate(worksheet_values[0])}
+    rows = worksheet_values[1:]
+    return {header: np.array(list(map(itemgetter(positions[header]), rows)), dtype=object) for header in FRAME_HEADERS}
+
+
+def worksheet_frame(worksheet_values):
+    """
+    Loads the contact and id columns of a worksheet snapshot (list of rows, header row first) into a DataFrame
+    indexed by data row number (1 = first row under the headers), columns named by normalized header.
+    Rows must all be as wide as the header row, as returned by get_all_values.
+    """
+    columns = _project_columns(worksheet_values)
+    return pd.DataFrame(columns, index=range(1, len(worksheet_values)), copy=False)
+
+
+def missing_contacts_mask(frame):
+    """rows with contact details, no contact or location id, and not a test or "john smith" entry"""
+    mask = (frame["contact id"].to_numpy() == "") & (frame["location id"].to_numpy() == "")
+    has_details = np.zeros(len(frame), dtype=bool)
+    for header in CONTACT_HEADERS:
+        has_details |= frame[header].to_numpy() != ""
+    mask &= has_details
+
+    # the name filters only need to look at the rows still in the running
+    candidates = frame.loc[mask, ["first name", "last name"]]
+    first_name = candidates["first name"].str.lower()
+    last_name = candidates["last name"].str.lower()
+    excluded = first_name.str.contains("test", regex=False) | last_name.str.contains("test", regex=False)
+    excluded |= (first_name == "john") & (last_name == "smith")
+    mask[mask] = ~excluded.to_numpy()
+    return mask
+
+
+def analyze_missing_contacts(worksheet_values):
+    """
+    Returns (count, rows) of the rows missing contact and location ids, rows as
+    [[row, first_name, last_name], [row, first_name, last_name]]
+    """
+    if len(worksheet_values) < 2:
+        return 0, []
+    frame = worksheet_frame(worksheet_values)
+    missing = frame.loc[missing_contacts_mask(frame), ["first name", "last name"]]
+    rows = [[row, first_name, last_name] for row, first_name, last_name in missing.itertuples(name=None)]
+    return len(rows), rows
+
+
+def missing_contacts_report(sheets):
+    """
+    Aggregates many sheets into one DataFrame of missing rows with REPORT_COLUMNS.
+    All sheets are stacked into a single frame so the masks run once for the whole report.
+    Sheets lacking any of FRAME_HEADERS are left out, see missing_headers.
+    sheets: iterable of (location_id, lds_link, worksheet_values)
+
+    report = missing_contacts_report(sheets)
+    counts = report.groupby("location id").size()
+    """
+    columns = {header: [] for header in FRAME_HEADERS}
+    sheet_keys = []
+    sheet_sizes = []
+    for location_id, lds_link, worksheet_values in sheets:
+        if len(worksheet_values) < 2 or missing_headers(worksheet_values):
+            continue
+        for header, values in _project_columns(worksheet_values).items():
+            columns[header].append(values)
+        sheet_keys.append((location_id, lds_link))
+        sheet_sizes.append(len(worksheet_values) - 1)
+
+    if not sheet_sizes:
+        return pd.DataFrame(columns=REPORT_COLUMNS)
+
+    frame = pd.DataFrame({header: np.concatenate(values) for header, values in columns.items()}, copy=False)
+    sheet_index = np.repeat(np.arange(len(sheet_sizes)), sheet_sizes)
+    sheet_starts = np.repeat(np.cumsum([0] + sheet_sizes[:-1]), sheet_sizes)
+    mask = missing_contacts_mask(frame)
+
+    keys = pd.DataFrame(sheet_keys, columns=["location id", "lds link"]).iloc[sheet_index[mask]]
+    report = keys.reset_index(drop=True)
+    report["row"] = (np.flatnonzero(mask) - sheet_starts[mask] + 1).astype(int)
+    report["first name"] = frame["first name"].to_numpy()[mask]
+    report["last name"] = frame["last name"].to_numpy()[mask]
+    return report[REPORT_COLUMNS]
@@ -1,12 +1,14 @@
-from flask import Flask, redirect, request, jsonify
-import requests
-from oauth_flask.utils import verify_response
+from flask import Flask, Response, redirect, request, jsonify
 from urllib.parse import urlencode
 from oauth_flask.keys import GoHighLevelConfig
-from oauth_flask.sqlite_db import SQLiteDB
+
+# the shared database, HTTP client and metrics registry are taken from utils, which imports them under the package's
+# own name. Importing them here as oauth_flask.* would load second copies with their own registry, rate limiters
+# and token cache, and /metrics would render an empty registry.
+from oauth_flask.utils import DB, GHL_CLIENT, REGISTRY, TOKEN_URL, verify_response, refresh_locations
 
 app = Flask(__name__)
-db = SQLiteDB()
+db = DB
 
 
 @app.route("/initiate")
@@ -44,8 +46,8 @@ def handle_callback():
         "redirect_uri": "http://localhost:3000/oauth/callback",
     }
 
-    headers = {"Accept": "application/json", "Content-Type": "application/x-www-form-urlencoded"}
-    response = requests.post("https://services.leadconnectorhq.com/oauth/token", data=data, headers=headers)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    response = GHL_CLIENT.post(TOKEN_URL, data=data, headers=headers)
 
     if verify_response(response.json()):
         db.insert_or_update_token(response.json())
@@ -55,5 +57,41 @@ def handle_callback():
     return jsonify({"status": "error"})
 
 
+@app.route("/refresh", methods=["GET", "POST"])
+def refresh():
+    """
+    Refreshes the tokens of one or more locations, given as locationId query parameters
+    or as {"locationIds": [...]} in a JSON body. Concurrent requests for the same location
+    share one token exchange with GHL.
+    """
+    location_ids = request.args.getlist("locationId")
+    body = {}
+    if request.get_data():
+        body = request.get_json(force=True, silent=True)
+        if not isinstance(body, dict):
+            return jsonify({"status": "error", "error": "body must be a JSON object"}), 400
+    body_ids = body.get("locationIds", [])
+    if not isinstance(body_ids, list) or not all(
+        isinstance(location_id, str) and location_id for location_id in body_ids
+    ):
+        return jsonify({"status": "error", "error": "locationIds must be a list of location id strings"}), 400
+    location_ids += [location_id for location_id in body_ids if location_id not in location_ids]
+    if not location_ids:
+        return jsonify({"status": "error", "error": "locationId is required"}), 400
+
+    results = refresh_locations(location_ids)
+    if len(location_ids) == 1:
+        result = results[location_ids[0]]
+        status_code = {"ok": 200, "skipped": 503}.get(result["status"], 502)
+        return jsonify({"locationId": location_ids[0], **result}), status_code
+    return jsonify(results)
+
+
+@app.route("/metrics")
+def metrics():
+    """upstream call, SQLite, row, rate limiter and circuit breaker metrics in the Prometheus text format"""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     app.run(port=3000)
@@ -0,0 +1,307 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+from gohighlevel_oauth_demo_flask.benchmarks.stubs import FakeSheets, FaultInjector, StubServer, SyntheticData
+
+STAGES = ["refresh", "contacts", "lds", "opportunities"]
+# seconds between resident memory samples
+RSS_INTERVAL = 0.05
+# the job engine's retry backoff is meant for live APIs, a benchmark run shouldn't sit in it
+BENCHMARK_ENV = {"JOB_RETRY_DELAY": "0.5", "JOB_MAX_RETRY_DELAY": "2"}
+
+
+class PeakRSS:
+    """samples the resident set size of this process in the background and keeps the highest value"""
+
+    def __init__(self, interval=RSS_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._sample, name="peak-rss", daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            if self.stop_event.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def percentile(values, q):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline sync benchmark against local GHL and Sheets stand-ins")
+    parser.add_argument("--locations", type=int, default=1000)
+    parser.add_argument("--contacts", type=int, default=1000, help="contacts per location")
+    parser.add_argument("--sheet-rows", type=int, default=500, help="lead data sheet rows per location")
+    parser.add_argument("--pipelines", type=int, default=3, help="pipelines per location")
+    parser.add_argument("--opportunities", type=int, default=100, help="opportunities per pipeline")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated subset of {','.join(STAGES)}")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="workers of every stage, each stage's default if unset"
+    )
+    parser.add_argument("--ghl-latency", type=float, default=0.0, help="milliseconds added to every GHL request")
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="milliseconds added to every Sheets call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="milliseconds of uniform jitter on both latencies")
+    parser.add_argument("--ghl-throttle-rate", type=float, default=0.0, help="share of GHL requests answered 429")
+    parser.add_argument("--sheets-throttle-rate", type=float, default=0.0, help="share of Sheets calls answered 429")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="Retry-After seconds sent with every 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="keep the client side rate limits, by default they are lifted to measure the code rather than the quotas",
+    )
+    parser.add_argument("--workdir", default=None, help="directory for the run's database and error.log, kept")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=None,
+        help="exit 1 when a stage's throughput drops or its peak RSS grows by more than this percentage",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs refresh_tokens, update_contacts_for_retailers, update_retailers_lead_data_sheets and update_lds_opportunities
+    against a stub GHL server and fake Sheets, and reports throughput, upstream latency and peak RSS per stage.
+    Nothing leaves the machine: GHL_SERVICES_URL and GHL_REST_V1_URL point at the stub, ClickUp tasks are only counted.
+
+    python -m oauth_flask.benchmarks.run --locations 100 --ghl-latency 50 --ghl-throttle-rate 0.01
+    python -m oauth_flask.benchmarks.run --output bench.json --baseline main.json --max-regression 10
+    """
+    args = parse_args(argv)
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise SystemExit(f"Unknown stages {unknown}, choose from {STAGES}")
+
+    data = SyntheticData(args.locations, args.contacts, args.sheet_rows, args.pipelines, args.opportunities)
+    jitter = args.jitter / 1000
+    ghl_faults = FaultInjector(args.ghl_latency / 1000, jitter, args.ghl_throttle_rate, args.retry_after, args.seed)
+    sheets_faults = FaultInjector(
+        args.sheets_latency / 1000, jitter, args.sheets_throttle_rate, args.retry_after, args.seed
+    )
+
+    # start the stub before anything opens threads or connections
+    server = StubServer(data, ghl_faults).start()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rgm-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.environ.update(
+        {
+            "GHL_SERVICES_URL": server.url,
+            "GHL_REST_V1_URL": f"{server.url}/v1",
+            "CLIENT_ID": "benchmark",
+            "CLIENT_SECRET": "benchmark",
+            "AGENCY_ACCESS_TOKEN": "agency-benchmark",
+            "MDS_SHEET_ID": "benchmark",
+        }
+    )
+    for name, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(name, value)
+
+    try:
+        # the modules read their configuration and open database.db and error.log relative to the cwd on import
+        os.chdir(workdir)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            from gohighlevel_oauth_demo_flask import utils
+
+        results = run(utils, data, FakeSheets(data, sheets_faults), stages, args)
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results["config"] = vars(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(json.load(file), results, args.max_regression)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.max_regression}%: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+def run(utils, data, google_client, stages, args):
+    from gohighlevel_oauth_demo_flask import metrics
+    from gohighlevel_oauth_demo_flask.rate_limit import RATE_LIMITERS, throttle_stats
+
+    if not args.rate_limits:
+        for limiter in RATE_LIMITERS.values():
+            limiter.global_bucket = None
+            limiter.keyed = None
+
+    # failed opportunity jobs open ClickUp tasks, count them instead
+    clickup_tasks = []
+    utils.create_clickup_task = lambda location_id, lds_link: clickup_tasks.append(location_id) or True
+    workers = {} if args.workers is None else {"max_workers": args.workers}
+
+    location_ids = data.location_ids()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        utils.DB.start_writer()
+        for location_id in location_ids:
+            utils.DB.insert_or_update_token(
+                {
+                    "userType": "Location",
+                    "companyId": "benchcompany",
+                    "locationId": location_id,
+                    "access_token": f"access-{location_id}-0",
+                    "token_type": "Bearer",
+                    "expires_in": 86399,
+                    "refresh_token": f"refresh-{location_id}-0",
+                    "scope": "contacts.readonly",
+                }
+            )
+        utils.DB.insert_many_retailer_records(
+            [(location_id, data.lds_link(location_id)) for location_id in location_ids]
+        )
+        utils.DB.stop_writer()
+
+    def refresh():
+        summary = utils.refresh_tokens(**workers)
+        return sum(result["status"] != "ok" for result in summary.values()), []
+
+    def contacts():
+        summary = utils.update_contacts_for_retailers(full_resync=True, **workers)
+        return sum("error" in counts or not counts["complete"] for counts in summary.values()), []
+
+    def jobs(summary):
+        return sum(job["state"] != "done" for job in summary.values()), [job["duration"] for job in summary.values()]
+
+    stage_runs = {
+        "refresh": (refresh, None, "tokens"),
+        "contacts": (contacts, "contacts", "contacts"),
+        # every invocation measures a fresh run, also in a kept --workdir that holds the last one
+        "lds": (
+            lambda: jobs(utils.update_retailers_lead_data_sheets(google_client, resume=False, **workers)),
+            "lds_rows",
+            "rows",
+        ),
+        "opportunities": (
+            lambda: jobs(utils.update_lds_opportunities(google_client, resume=False, **workers)),
+            "opportunities",
+            "opportunities",
+        ),
+    }
+
+    results = {"stages": {}}
+    for stage in stages:
+        handler, rows_kind, unit = stage_runs[stage]
+        metrics_before = metrics.snapshot()
+        throttle_before = throttle_stats()
+        started_at = time.perf_counter()
+        with PeakRSS() as rss, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            failed, job_durations = handler()
+        seconds = time.perf_counter() - started_at
+
+        summary = metrics.summary(metrics_before)
+        items = summary["rows"].get(rows_kind, 0) if rows_kind else len(location_ids) - failed
+        results["stages"][stage] = {
+            "items": items,
+            "unit": unit,
+            "failed": failed,
+            "seconds": round(seconds, 3),
+            "throughput": round(items / seconds, 1) if seconds else None,
+            "upstream": upstream_totals(metrics, metrics_before),
+            "throttled": {
+                api: stats["throttled"] - throttle_before[api]["throttled"]
+                for api, stats in throttle_stats().items()
+                if stats["throttled"] > throttle_before[api]["throttled"]
+            },
+            "job_p50": percentile(job_durations, 0.5),
+            "job_p99": percentile(job_durations, 0.99),
+            "peak_rss_mb": round(rss.peak / 2**20, 1),
+            "endpoints": summary["upstream"],
+            "sqlite": summary["sqlite"],
+        }
+    results["clickup_tasks"] = len(clickup_tasks)
+    return results
+
+
+def upstream_totals(metrics, since):
+    """calls and estimated p50 and p99 latency over every upstream call since the snapshot"""
+    histogram = metrics.UPSTREAM_LATENCY
+    before = since.get(histogram.name, {})
+    counts = [0] * (len(histogram.buckets) + 1)
+    for key, (now, _, _) in histogram.snapshot().items():
+        then = before.get(key, ([0] * len(now), 0.0, 0))[0]
+        counts = [total + after - previous for total, after, previous in zip(counts, now, then)]
+    return {"calls": sum(counts), "p50": histogram.quantile(0.5, counts), "p99": histogram.quantile(0.99, counts)}
+
+
+def print_results(results):
+    for stage, result in results["stages"].items():
+        upstream = result["upstream"]
+        throttled = ", ".join(f"{api} {count}" for api, count in result["throttled"].items()) or "none"
+        line = (
+            f"{stage:<14} {result['items']:>9} {result['unit']:<13} {result['seconds']:>9.2f}s "
+            f"{result['throughput'] or 0:>10.1f}/s  {upstream['calls']} upstream calls, "
+            f"p50 <= {upstream['p50']}s, p99 <= {upstream['p99']}s, 429s: {throttled}, "
+            f"peak RSS {result['peak_rss_mb']} MB"
+        )
+        if result["job_p50"] is not None:
+            line += f", per location p50 {result['job_p50']:.3f}s p99 {result['job_p99']:.3f}s"
+        if result["failed"]:
+            line += f", {result['failed']} failed"
+        print(line)
+        for endpoint, entry in sorted(result["endpoints"].items(), key=lambda item: -item[1]["seconds"]):
+            print(
+                f"    {endpoint}: {entry['calls']} calls, {entry['errors']} errors, "
+                f"p50 <= {entry['p50']}s, p99 <= {entry['p99']}s"
+            )
+    if results.get("clickup_tasks"):
+        print(f"{results['clickup_tasks']} ClickUp tasks would have been created")
+
+
+def compare(baseline, results, max_regression=None):
+    """
+    Prints each stage's throughput and peak RSS change against the baseline and returns the stages that regressed
+    by more than max_regression percent
+    """
+    regressions = []
+    for stage, result in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before or not before.get("throughput") or not result["throughput"]:
+            continue
+        throughput_change = (result["throughput"] / before["throughput"] - 1) * 100
+        rss_change = (result["peak_rss_mb"] / before["peak_rss_mb"] - 1) * 100
+        print(f"{stage:<14} throughput {throughput_change:+.1f}%, peak RSS {rss_change:+.1f}% against the baseline")
+        if max_regression is not None and (-throughput_change > max_regression or rss_change > max_regression):
+            regressions.append(stage)
+    return regressions
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,458 @@
+import json
+import multiprocessing
+import random
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import requests
+from gspread.exceptions import APIError, SpreadsheetNotFound
+
+# fmt: off
+FIRST_NAMES = [
+    "James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+    "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen",
+    "Daniel", "Lisa", "Matthew", "Nancy", "Anthony",
+]
+LAST_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+    "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark", "Ramirez", "Lewis", "Robinson",
+    "Walker", "Young", "Allen", "King", "Wright", "Scott", "Torres", "Nguyen", "Hill", "Flores",
+]
+# fmt: on
+LDS_COLUMNS = ["First Name", "Last Name", "Email", "Phone", "Contact ID", "Location ID", "Opportunity ID", "Processed"]
+MDS_COLUMNS = ["Retailer", "GHL Location ID", "Lead Data Sheet Link", "Status"]
+# processes serving the GHL stub
+STUB_PROCESSES = 2
+CELL_RANGE = re.compile(r"^([A-Z]+)(\d+)(?::([A-Z]+)(\d*))?$")
+
+
+class SyntheticData:
+    """
+    Deterministic synthetic tenant: locations with their contacts, lead data sheet rows, pipelines and opportunities.
+    Everything is derived from indexes, so the stub server process and the fake Sheets backend agree without
+    sharing state and nothing has to be held in memory up front.
+    """
+
+    def __init__(self, locations=1000, contacts=1000, sheet_rows=500, pipelines=3, opportunities=100):
+        self.locations = locations
+        self.contacts = contacts
+        self.sheet_rows = sheet_rows
+        self.pipelines = pipelines
+        self.opportunities = opportunities
+
+    def location_ids(self):
+        return [f"bench{index:015d}" for index in range(self.locations)]
+
+    @staticmethod
+    def location_index(location_id):
+        return int(location_id[len("bench") :])
+
+    @staticmethod
+    def lds_link(location_id):
+        return f"https://docs.google.com/spreadsheets/d/{location_id}/edit"
+
+    def contact(self, location_id, index):
+        first_name = FIRST_NAMES[index % len(FIRST_NAMES)]
+        last_name = LAST_NAMES[(index // len(FIRST_NAMES)) % len(LAST_NAMES)]
+        return {
+            "id": f"{location_id}c{index:07d}",
+            "locationId": location_id,
+            "firstName": first_name,
+            "lastName": last_name,
+            "contactName": f"{first_name} {last_name}",
+            "email": f"{first_name}.{last_name}.{index}@example.com".lower(),
+            "phone": "+1" + self.phone_digits(index),
+            "timezone": "America/New_York",
+            "dateUpdated": f"2024-01-01T00:00:{index % 60:02d}.000Z",
+        }
+
+    @staticmethod
+    def phone_digits(index):
+        return f"{200 + (index // 10000) % 700}555{index % 10000:04d}"
+
+    def lead_data_rows(self, location_id):
+        """
+        Header row plus sheet_rows rows spread over the location's contacts, matching them in the ways the sheets do:
+        a formatted phone number, an upper case email, the exact name, a typo in the last name or not at all.
+        Every tenth location's sheet has no Opportunity ID column yet.
+        """
+        columns = list(LDS_COLUMNS)
+        if self.location_index(location_id) % 10 == 0:
+            columns.remove("Opportunity ID")
+        rows = [columns]
+        step = max(1, self.contacts // max(1, self.sheet_rows))
+        for row_number in range(self.sheet_rows):
+            contact = self.contact(location_id, (row_number * step) % max(1, self.contacts))
+            digits = self.phone_digits((row_number * step) % max(1, self.contacts))
+            first_name, last_name, email, phone = contact["firstName"], contact["lastName"], "", ""
+            kind = row_number % 5
+            if kind == 0:
+                phone = f"({digits[:3]}) {digits[3:6]}-{digits[6:]}"
+            elif kind == 1:
+                email = contact["email"].upper()
+            elif kind == 3:
+                last_name = last_name[0] + last_name[2] + last_name[1] + last_name[3:]
+            elif kind == 4:
+                first_name, last_name = f"Walk-in {row_number}", "Unknown"
+            values = {"First Name": first_name, "Last Name": last_name, "Email": email, "Phone": phone}
+            rows.append([values.get(column, "") for column in columns])
+        return rows
+
+    def pipeline_ids(self, location_id):
+        return [f"{location_id}p{number}" for number in range(self.pipelines)]
+
+    def opportunity(self, pipeline_id, index):
+        location_id, number = pipeline_id.rsplit("p", 1)
+        # spread every pipeline's opportunities over the contacts, several pipelines may share a contact
+        contact_index = (int(number) * 7 + index * max(1, self.contacts // max(1, self.opportunities))) % max(
+            1, self.contacts
+        )
+        return {
+            "id": f"{pipeline_id}o{index:06d}",
+            "pipelineId": pipeline_id,
+            "contact": {"id": f"{location_id}c{contact_index:07d}"},
+            "updatedAt": f"2024-01-{1 + index % 28:02d}T00:00:00.000Z",
+        }
+
+
+class FaultInjector:
+    """added latency (seconds, uniformly jittered by jitter) and the share of calls answered with HTTP 429"""
+
+    def __init__(self, latency=0.0, jitter=0.0, throttle_rate=0.0, retry_after=0.05, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    # picklable, the stub server process gets its own copy
+    def __getstate__(self):
+        return {name: value for name, value in vars(self).items() if name != "lock"}
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        if not self.throttle_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.throttle_rate
+
+
+class GHLStubHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the LeadConnector token endpoint, GET /contacts/ and POST /contacts/search (v2)
+    and GET /locations/, /pipelines/ and /pipelines/:id/opportunities (v1, under /v1).
+    Refresh tokens are "refresh-<locationId>-<n>" and exchange for "access-<locationId>-<n + 1>".
+    """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, don't let Nagle hold the body for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def route(self, method):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        data = self.server.data
+        faults = self.server.faults
+
+        faults.delay()
+        if faults.throttled():
+            return self.send_json(429, {"message": "Too many requests"}, {"Retry-After": str(faults.retry_after)})
+
+        path = url.path
+        if method == "POST" and path == "/oauth/token":
+            return self.token(parse_qs(body.decode()))
+        if method == "GET" and path == "/contacts/":
+            return self.contacts(query)
+        if method == "POST" and path == "/contacts/search":
+            # every contact was fetched by the full sync, an incremental sync finds nothing new
+            return self.send_json(200, {"contacts": [], "total": 0})
+        if method == "GET" and path == "/v1/locations/":
+            locations = [
+                {"id": location_id, "name": location_id, "apiKey": f"access-{location_id}-0"}
+                for location_id in data.location_ids()
+            ]
+            return self.send_json(200, {"locations": locations})
+        if method == "GET" and path == "/v1/pipelines/":
+            location_id = self.headers.get("Authorization", "").split("-")[1]
+            pipelines = [{"id": pipeline_id, "name": pipeline_id} for pipeline_id in data.pipeline_ids(location_id)]
+            return self.send_json(200, {"pipelines": pipelines})
+        match = re.match(r"^/v1/pipelines/([^/]+)/opportunities$", path)
+        if method == "GET" and match:
+            return self.opportunities(match.group(1), query)
+        return self.send_json(404, {"message": f"No stub for {method} {path}"})
+
+    def token(self, form):
+        refresh_token = form.get("refresh_token", [""])[-1]
+        parts = refresh_token.split("-")
+        if len(parts) != 3 or parts[0] != "refresh":
+            return self.send_json(400, {"error": "invalid_grant", "error_description": "Invalid refresh token"})
+        location_id, number = parts[1], int(parts[2]) + 1
+        token = {
+            "access_token": f"access-{location_id}-{number}",
+            "refresh_token": f"refresh-{location_id}-{number}",
+            "token_type": "Bearer",
+            "expires_in": 86399,
+            "scope": "contacts.readonly opportunities.readonly",
+            "userType": "Location",
+            "companyId": "benchcompany",
+            "locationId": location_id,
+        }
+        return self.send_json(200, token)
+
+    def contacts(self, query):
+        data = self.server.data
+        location_id = query["locationId"]
+        limit = int(query.get("limit", 20))
+        start = int(query.get("startAfter", 0))
+        stop = min(start + limit, data.contacts)
+        contacts = [data.contact(location_id, index) for index in range(start, stop)]
+        next_page_url = None
+        if stop < data.contacts:
+            next_query = urlencode({"locationId": location_id, "limit": limit, "startAfter": stop})
+            next_page_url = f"http://{self.headers['Host']}/contacts/?{next_query}"
+        return self.send_json(
+            200, {"contacts": contacts, "meta": {"total": data.contacts, "nextPageUrl": next_page_url}}
+        )
+
+    def opportunities(self, pipeline_id, query):
+        data = self.server.data
+        limit = int(query.get("limit", 20))
+        start = int(query.get("startAfter", 0))
+        stop = min(start + limit, data.opportunities)
+        opportunities = [data.opportunity(pipeline_id, index) for index in range(start, stop)]
+        next_page_url = None
+        if stop < data.opportunities:
+            next_query = urlencode({"limit": limit, "startAfter": stop})
+            next_page_url = f"http://{self.headers['Host']}/v1/pipelines/{pipeline_id}/opportunities?{next_query}"
+        return self.send_json(200, {"opportunities": opportunities, "meta": {"nextPageUrl": next_page_url}})
+
+    def send_json(self, status_code, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the client keeps a pool of keep-alive connections open, don't refuse them while threads spin up
+    request_queue_size = 256
+
+    def server_bind(self):
+        # every stub process listens on the same port and the kernel spreads the connections between them
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def serve(data, faults, port, number, ready):
+    faults.random.seed(faults.seed + number)
+    server = StubHTTPServer(("127.0.0.1", port), GHLStubHandler)
+    server.data = data
+    server.faults = faults
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StubServer:
+    """
+    Runs the GHL stub in processes of its own, so its CPU and memory don't count against the code being measured
+    and serializing responses doesn't become the bottleneck. Every process listens on the same port.
+
+    from oauth_flask.benchmarks.stubs import FaultInjector, StubServer, SyntheticData
+
+    server = StubServer(SyntheticData(locations=10), FaultInjector(latency=0.02)).start()
+    os.environ["GHL_SERVICES_URL"] = server.url
+    os.environ["GHL_REST_V1_URL"] = f"{server.url}/v1"
+    """
+
+    def __init__(self, data, faults=None, processes=STUB_PROCESSES):
+        self.data = data
+        self.faults = faults or FaultInjector()
+        self.processes = max(1, processes if hasattr(socket, "SO_REUSEPORT") else 1)
+        self.workers = []
+        self.url = None
+
+    def start(self):
+        ready = multiprocessing.Queue()
+        port = 0
+        for number in range(self.processes):
+            process = multiprocessing.Process(
+                target=serve, args=(self.data, self.faults, port, number, ready), name=f"ghl-stub-{number}", daemon=True
+            )
+            process.start()
+            self.workers.append(process)
+            # the first process picks a free port, the others join it
+            port = ready.get(timeout=30)
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    def stop(self):
+        for process in self.workers:
+            process.terminate()
+        for process in self.workers:
+            process.join()
+        self.workers = []
+
+
+def column_index(letters):
+    """A1 column letters to a 0-based column index: A -> 0, AA -> 26"""
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+class FakeWorksheet:
+    """the gspread Worksheet calls CachedWorksheet makes, against an in-memory grid"""
+
+    def __init__(self, rows, client):
+        self.rows = rows
+        self.client = client
+        self.lock = threading.Lock()
+
+    def get_all_values(self):
+        self.client.call()
+        with self.lock:
+            width = max((len(row) for row in self.rows), default=0)
+            return [row + [""] * (width - len(row)) for row in self.rows]
+
+    def row_values(self, row):
+        self.client.call()
+        with self.lock:
+            values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def batch_get(self, ranges, major_dimension="ROWS"):
+        self.client.call()
+        value_ranges = []
+        with self.lock:
+            for cell_range in ranges:
+                first_letters, first_row, _, _ = CELL_RANGE.match(cell_range).groups()
+                index = column_index(first_letters)
+                values = [row[index] if index < len(row) else "" for row in self.rows[int(first_row) - 1 :]]
+                while values and values[-1] == "":
+                    values.pop()
+                value_ranges.append([values] if values else [])
+        return value_ranges
+
+    def batch_update(self, data, **kwargs):
+        self.client.call()
+        with self.lock:
+            for update in data:
+                first_letters, first_row, _, _ = CELL_RANGE.match(update["range"]).groups()
+                index = column_index(first_letters)
+                for offset, (value,) in enumerate(update["values"]):
+                    row_number = int(first_row) - 1 + offset
+                    while len(self.rows) <= row_number:
+                        self.rows.append([])
+                    row = self.rows[row_number]
+                    row.extend([""] * (index + 1 - len(row)))
+                    row[index] = value
+        return {"totalUpdatedCells": sum(len(update["values"]) for update in data)}
+
+    def insert_cols(self, values, col=1, **kwargs):
+        self.client.call()
+        with self.lock:
+            for row_number, row in enumerate(self.rows):
+                column = values[0] if values else []
+                row.insert(col - 1, column[row_number] if row_number < len(column) else "")
+        return True
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheet, client):
+        self.worksheet = worksheet
+        self.client = client
+
+    def get_worksheet(self, index):
+        self.client.call()
+        return self.worksheet if index == 0 else None
+
+
+class FakeSheets:
+    """
+    In-process stand-in for a gspread client: open_by_url opens the synthetic lead data sheet of a location,
+    open_by_key the master data sheet listing every location. Sheets are built on first open and keep their writes,
+    so a later stage sees the IDs written by an earlier one. Throttled calls raise a 429 APIError like gspread.
+
+    from oauth_flask.benchmarks.stubs import FakeSheets, SyntheticData
+
+    google_client = FakeSheets(SyntheticData(locations=10), FaultInjector(latency=0.05))
+    update_retailers_lead_data_sheets(google_client)
+    """
+
+    def __init__(self, data, faults=None):
+        self.data = data
+        self.faults = faults or FaultInjector()
+        self.spreadsheets = {}
+        self.lock = threading.Lock()
+
+    def call(self):
+        self.faults.delay()
+        if self.faults.throttled():
+            response = requests.Response()
+            response.status_code = 429
+            response.headers["Retry-After"] = str(self.faults.retry_after)
+            response._content = json.dumps(
+                {"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}}
+            ).encode()
+            raise APIError(response)
+
+    def _spreadsheet(self, key, build):
+        with self.lock:
+            spreadsheet = self.spreadsheets.get(key)
+            if spreadsheet is None:
+                spreadsheet = self.spreadsheets[key] = FakeSpreadsheet(FakeWorksheet(build(), self), self)
+            return spreadsheet
+
+    def open_by_url(self, url):
+        self.call()
+        match = re.search(r"/spreadsheets/d/([^/]+)", url)
+        if not match:
+            raise SpreadsheetNotFound(url)
+        location_id = match.group(1)
+        return self._spreadsheet(location_id, lambda: self.data.lead_data_rows(location_id))
+
+    def open_by_key(self, key):
+        self.call()
+
+        def master_data_rows():
+            return [MDS_COLUMNS] + [
+                [location_id, location_id, self.data.lds_link(location_id), "Active"]
+                for location_id in self.data.location_ids()
+            ]
+
+        return self._spreadsheet(f"mds:{key}", master_data_rows)
@@ -0,0 +1,113 @@
+import threading
+import time
+
+# error class -> (seconds a target is skipped once its breaker opens, consecutive failures that open it)
+ERROR_CLASSES = {
+    # the service account lost access or the sheet was deleted, nothing changes until someone fixes it
+    "permission_denied": (6 * 3600, 1),
+    "not_found": (24 * 3600, 1),
+    "invalid_url": (24 * 3600, 1),
+    # the refresh token was revoked or is invalid, only a new authorisation fixes it
+    "invalid_token": (6 * 3600, 1),
+    "error": (5 * 60, 3),
+}
+# every further failure doubles the cooldown, up to this many times the error class's base cooldown
+MAX_COOLDOWN_FACTOR = 8
+# seconds the single probe of a half-open breaker has before another caller may probe
+PROBE_WINDOW = 5 * 60
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def classify_status(status_code):
+    """
+    error class of an HTTP status code, None when the failure says nothing about the target: quota (429),
+    server errors (5xx) and anything else transient are retried by the caller instead of counting against it
+    """
+    return {401: "invalid_token", 403: "permission_denied", 404: "not_found"}.get(status_code)
+
+
+class CircuitBreaker:
+    """
+    Persistent failure registry and circuit breaker for one kind of target (lead data sheet URLs, locations' tokens).
+    Failures are stored in rgm_failures. Once a target has failed often enough for its error class the breaker opens
+    and calls are skipped until the cooldown expires. The first caller after that gets to probe the target,
+    a success clears the record and a failure opens the breaker again for twice as long.
+
+    from oauth_flask.circuit_breaker import CircuitBreaker
+
+    breaker = CircuitBreaker(DB, "lds")
+    if breaker.allow(lds_link):
+        ...
+        breaker.record_failure(lds_link, "permission_denied", str(e))
+    """
+
+    def __init__(self, db, kind, error_classes=None):
+        self.db = db
+        self.kind = kind
+        self.error_classes = {**ERROR_CLASSES, **(error_classes or {})}
+        # targets this process is probing or that failed before, a success clears their record
+        self.known_failing = set()
+        self.counters = {"skipped": 0, "probes": 0, "failures": 0, "recovered": 0}
+        self.lock = threading.Lock()
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def allow(self, target, probe=True):
+        """
+        False while the target's breaker is open. Once the cooldown expired only the caller that claims the probe
+        is let through, unless probe is False, which lets every caller through without probing.
+        """
+        failure = self.db.fetch_failure(self.kind, target)
+        if failure is None:
+            return True
+        with self.lock:
+            self.known_failing.add(target)
+
+        now = time.time()
+        open_until = failure[7]
+        if open_until and open_until > now:
+            self._count("skipped")
+            return False
+        if not open_until or not probe:
+            return True
+        if self.db.claim_failure_probe(self.kind, target, now + PROBE_WINDOW):
+            self._count("probes")
+            return True
+        self._count("skipped")
+        return False
+
+    def is_open(self, target):
+        failure = self.db.fetch_failure(self.kind, target)
+        return failure is not None and bool(failure[7]) and failure[7] > time.time()
+
+    def record_failure(self, target, error_class, error=None):
+        """records a failure and returns True when the target's breaker is open afterwards"""
+        cooldown, threshold = self.error_classes.get(error_class, self.error_classes["error"])
+        with self.lock:
+            self.known_failing.add(target)
+        self._count("failures")
+        return self.db.record_failure(
+            self.kind, target, error_class, error, cooldown, cooldown * MAX_COOLDOWN_FACTOR, threshold
+        )
+
+    def record_success(self, target):
+        with self.lock:
+            if target not in self.known_failing:
+                return False
+            self.known_failing.discard(target)
+        if self.db.clear_failure(self.kind, target):
+            self._count("recovered")
+        return True
+
+    def open_targets(self):
+        """returns [(target, error_class, failures, open_until)] of every target currently skipped"""
+        return self.db.fetch_open_failures(self.kind)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
@@ -0,0 +1,81 @@
+from gohighlevel_oauth_demo_flask.fuzzy_match import best_name_match
+from gohighlevel_oauth_demo_flask.normalize import name_block_key
+
+# column positions of a rgm_contacts row
+ID, LOCATION_ID, EMAIL, TIMEZONE, FIRST_NAME, LAST_NAME, CONTACT_NAME, PHONE = range(8)
+PHONE_KEY, EMAIL_KEY, FIRST_NAME_KEY, LAST_NAME_KEY, NAME_BLOCK = range(8, 13)
+
+
+class ContactIndex:
+    """
+    In-memory hash indexes over one location's rgm_contacts rows, so each lead data sheet row
+    resolves without a query. lookup() follows the same precedence as SQLiteDB.attempt_contact_retrieval:
+    the first contact (in table order) matching the phone or the email, then the first matching first and last name.
+    Contacts are indexed on their normalized keys, lookup() takes keys from normalize.contact_match_keys.
+
+    from oauth_flask.contact_index import ContactIndex
+    from oauth_flask.normalize import contact_match_keys
+
+    index = ContactIndex.from_db(DB, location_id)
+    phone_key, email_key, first_name_key, last_name_key = contact_match_keys(phone_number, email, first_name, last_name)
+    record = index.lookup(phone_key, email_key, first_name_key, last_name_key)
+    record = record or index.fuzzy_lookup(first_name_key, last_name_key)
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.by_phone = {}
+        self.by_email = {}
+        self.by_name = {}
+        # name block -> positions, built on the first fuzzy lookup
+        self.blocks = None
+        for position, record in enumerate(records):
+            if record[PHONE_KEY] is not None:
+                self.by_phone.setdefault(record[PHONE_KEY], position)
+            if record[EMAIL_KEY] is not None:
+                self.by_email.setdefault(record[EMAIL_KEY], position)
+            if record[FIRST_NAME_KEY] is not None and record[LAST_NAME_KEY] is not None:
+                self.by_name.setdefault((record[FIRST_NAME_KEY], record[LAST_NAME_KEY]), position)
+
+    @classmethod
+    def from_db(cls, db, location_id):
+        return cls(db.fetch_location_contacts(location_id))
+
+    def __len__(self):
+        return len(self.records)
+
+    def lookup(self, phone_number, email, first_name, last_name):
+        positions = [
+            index.get(key) for index, key in ((self.by_phone, phone_number), (self.by_email, email)) if key is not None
+        ]
+        positions = [position for position in positions if position is not None]
+        if positions:
+            return self.records[min(positions)]
+
+        if first_name is not None and last_name is not None:
+            position = self.by_name.get((first_name, last_name))
+            if position is not None:
+                return self.records[position]
+
+        return None
+
+    def fuzzy_lookup(self, first_name, last_name, threshold=None, margin=None):
+        """
+        Closest fuzzy name match among the contacts sharing the name block of last_name,
+        see fuzzy_match.best_name_match. Takes normalized name keys.
+        """
+        block = name_block_key(last_name)
+        if first_name is None or block is None:
+            return None
+        if self.blocks is None:
+            self.blocks = {}
+            for position, record in enumerate(self.records):
+                if record[NAME_BLOCK] is not None:
+                    self.blocks.setdefault(record[NAME_BLOCK], []).append(position)
+
+        candidates = (
+            (self.records[position][FIRST_NAME_KEY], self.records[position][LAST_NAME_KEY], self.records[position])
+            for position in self.blocks.get(block, ())
+        )
+        options = {key: value for key, value in (("threshold", threshold), ("margin", margin)) if value is not None}
+        return best_name_match(first_name, last_name, candidates, **options)
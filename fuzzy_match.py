@@ -0,0 +1,77 @@
+from gohighlevel_oauth_demo_flask.keys import MatchConfig
+
+
+def jaro_winkler(a, b, prefix_scale=0.1):
+    """Jaro-Winkler similarity of two strings, 1.0 when equal and 0.0 when nothing matches"""
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    window = max(max(len(a), len(b)) // 2 - 1, 0)
+    a_matched = [False] * len(a)
+    b_matched = [False] * len(b)
+    matches = 0
+    for i, char in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not b_matched[j] and b[j] == char:
+                a_matched[i] = b_matched[j] = True
+                matches += 1
+                break
+    if not matches:
+        return 0.0
+
+    b_chars = [char for char, matched in zip(b, b_matched) if matched]
+    a_chars = [char for char, matched in zip(a, a_matched) if matched]
+    transpositions = sum(x != y for x, y in zip(a_chars, b_chars)) / 2
+    jaro = (matches / len(a) + matches / len(b) + (matches - transpositions) / matches) / 3
+
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * prefix_scale * (1 - jaro)
+
+
+def name_score(first_name, last_name, candidate_first_name, candidate_last_name):
+    """
+    Similarity of the last names when the first names are equal, 0.0 otherwise. Close first names are often
+    different people ("mark" and "mary", "eric" and "erica"), and last names differing by more than one letter
+    in length are different names rather than typos ("martin" and "martinez").
+    """
+    if first_name != candidate_first_name or abs(len(last_name) - len(candidate_last_name)) > 1:
+        return 0.0
+    return jaro_winkler(last_name, candidate_last_name)
+
+
+def best_name_match(
+    first_name,
+    last_name,
+    candidates,
+    threshold=MatchConfig.FUZZY_NAME_THRESHOLD,
+    margin=MatchConfig.FUZZY_NAME_MARGIN,
+):
+    """
+    Returns the candidate whose name scores highest against first_name and last_name, or None when no candidate
+    reaches threshold or the runner-up is within margin of it. Ties go to the earliest candidate.
+    candidates: iterable of (candidate_first_name, candidate_last_name, item)
+    """
+    if first_name is None or last_name is None:
+        return None
+    best = runner_up = None
+    best_score = runner_up_score = 0.0
+    for candidate_first_name, candidate_last_name, item in candidates:
+        if candidate_first_name is None or candidate_last_name is None:
+            continue
+        score = name_score(first_name, last_name, candidate_first_name, candidate_last_name)
+        if best is None or score > best_score:
+            runner_up, runner_up_score = best, best_score
+            best, best_score = item, score
+        elif runner_up is None or score > runner_up_score:
+            runner_up, runner_up_score = item, score
+
+    if best is None or best_score < threshold:
+        return None
+    if runner_up is not None and best_score - runner_up_score < margin:
+        return None
+    return best
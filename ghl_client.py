@@ -0,0 +1,70 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+from gohighlevel_oauth_demo_flask.keys import GoHighLevelConfig
+from gohighlevel_oauth_demo_flask.metrics import UPSTREAM_CALLS, UPSTREAM_ERRORS, UPSTREAM_LATENCY, endpoint_label
+from gohighlevel_oauth_demo_flask.rate_limit import RATE_LIMITERS
+
+SERVICES_URL = GoHighLevelConfig.SERVICES_URL
+REST_V1_URL = GoHighLevelConfig.REST_V1_URL
+TOKEN_URL = f"{SERVICES_URL}/oauth/token"
+API_VERSION = "2021-07-28"
+TIMEOUT = 30
+
+
+class GHLClient:
+    """
+    Shared HTTP client for the LeadConnector (v2) and GoHighLevel (v1) APIs.
+    Owns one pooled keep-alive requests.Session so paginated runs reuse connections.
+    Per-location headers are built per call and the session itself is never mutated after
+    construction, which keeps a single instance safe to share between threads.
+    Requests go through the ghl_v1 or ghl_v2 rate limiter, keyed by access token, which paces
+    them and retries 429 responses with backoff.
+    """
+
+    def __init__(self, pool_size=GoHighLevelConfig.HTTP_POOL_SIZE, timeout=TIMEOUT, rate_limited=True):
+        self.timeout = timeout
+        self.rate_limited = rate_limited
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @staticmethod
+    def headers(access_token=None, version=None, extra=None):
+        headers = {"Accept": "application/json"}
+        if access_token:
+            headers["Authorization"] = f"Bearer {access_token}"
+        if version:
+            headers["Version"] = version
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def request(self, method, url, access_token=None, version=None, headers=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        headers = self.headers(access_token, version, headers)
+        api = "ghl_v1" if url.startswith(REST_V1_URL) else "ghl_v2"
+        endpoint = f"{method} {endpoint_label(url)}"
+        if not self.rate_limited:
+            with UPSTREAM_LATENCY.time(api=api, endpoint=endpoint):
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            UPSTREAM_CALLS.inc(api=api, endpoint=endpoint)
+            if response.status_code >= 400:
+                UPSTREAM_ERRORS.inc(api=api, endpoint=endpoint, status=response.status_code)
+            return response
+        return RATE_LIMITERS[api].call(
+            self.session.request, method, url, key=access_token, endpoint=endpoint, headers=headers, **kwargs
+        )
+
+    def get(self, url, access_token=None, version=None, **kwargs):
+        return self.request("GET", url, access_token=access_token, version=version, **kwargs)
+
+    def post(self, url, access_token=None, version=None, **kwargs):
+        return self.request("POST", url, access_token=access_token, version=version, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+GHL_CLIENT = GHLClient()
@@ -0,0 +1,204 @@
+import logging
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gohighlevel_oauth_demo_flask.keys import JobConfig
+from gohighlevel_oauth_demo_flask.leases import LEASE_OWNER, Heartbeat
+from gohighlevel_oauth_demo_flask.metrics import log_summary, snapshot
+
+# never sleep longer than this while waiting for a job's retry to come due
+MAX_IDLE = 5
+# seconds a worker backs off after the database was locked or busy, and how often it retries recording a result
+DB_ERROR_DELAY = 1
+DB_RETRIES = 3
+
+
+class PermanentJobError(Exception):
+    """raised by a job handler when retrying the location can't help, the job fails without further attempts"""
+
+    pass
+
+
+class JobEngine:
+    """
+    Runs one job per location for a run type out of the rgm_jobs table.
+    Workers claim due jobs, a handler that raises is retried with a jittered exponential backoff while the other
+    workers keep going, and after max_attempts (or a PermanentJobError) the job fails and on_failure is called.
+    Job state lives in SQLite, so a run that crashed resumes with the jobs it had not finished.
+    Claimed jobs are leased for lease_seconds and renewed by a heartbeat while they run, so engines in several
+    processes, on any host sharing the database, can work the same run and take over the jobs of a dead one.
+
+    from oauth_flask.jobs import JobEngine
+
+    engine = JobEngine(DB, "lds_contacts", handler=update_location, max_workers=4)
+    summary = engine.run(location_ids)
+    """
+
+    def __init__(
+        self,
+        db,
+        run_type,
+        handler,
+        max_workers=JobConfig.WORKERS,
+        max_attempts=JobConfig.MAX_ATTEMPTS,
+        retry_delay=JobConfig.RETRY_DELAY,
+        max_retry_delay=JobConfig.MAX_RETRY_DELAY,
+        on_failure=None,
+        lease_seconds=JobConfig.LEASE_SECONDS,
+        join_window=JobConfig.RUN_JOIN_SECONDS,
+    ):
+        self.db = db
+        self.run_type = run_type
+        self.handler = handler
+        self.max_workers = max(1, max_workers)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_failure = on_failure
+        self.lease_seconds = lease_seconds
+        self.join_window = join_window
+        # locationId -> worker_id of the jobs this engine is running
+        self.running = {}
+        self.running_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        # bumped whenever a worker finishes a job, idle workers wake up on it instead of sleeping out MAX_IDLE
+        self.finished = 0
+        self.finished_changed = threading.Condition()
+        # metrics summary of the last run, see metrics.summary
+        self.metrics = None
+
+    def backoff_delay(self, attempts):
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def run(self, location_ids, resume=True, wait_for_retries=True, run_key=None):
+        """
+        Works through the run until every job is done or failed. Without wait_for_retries it returns once no job
+        is due, leaving the retries for the next run to resume.
+        Engines pass the same run_key to share a run, without one they join the unfinished run of their run type
+        or one finished less than join_window seconds ago, see SQLiteDB.start_job_run.
+        Returns {locationId: {"state": str, "attempts": int, "duration": float | None, "error": str | None}}
+        """
+        metrics_before = snapshot()
+        run_id = self.db.start_job_run(
+            self.run_type, location_ids, resume=resume, run_key=run_key, join_window=self.join_window
+        )
+        heartbeat = Heartbeat(self.lease_seconds / 3, self._renew_leases, name=f"jobs-{self.run_type}").start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                workers = [
+                    executor.submit(self._work, run_id, f"{LEASE_OWNER}-{number}", wait_for_retries)
+                    for number in range(self.max_workers)
+                ]
+                for worker in workers:
+                    worker.result()
+        finally:
+            heartbeat.stop()
+        self.metrics = log_summary(f"{self.run_type} run {run_id}", metrics_before)
+        return self.summary(run_id)
+
+    def _renew_leases(self):
+        with self.running_lock:
+            jobs = list(self.running.items())
+        if jobs:
+            self.db.renew_job_leases(self.run_type, jobs, self.lease_seconds)
+
+    def summary(self, run_id):
+        return {
+            job[1]: {"state": job[3], "attempts": job[4], "duration": job[10], "error": job[11]}
+            for job in self.db.fetch_run_jobs(self.run_type, run_id)
+        }
+
+    def _work(self, run_id, worker_id, wait_for_retries):
+        while not self.stop_event.is_set():
+            finished = self.finished
+            try:
+                job = self.db.claim_job(self.run_type, run_id, worker_id, self.lease_seconds)
+            except sqlite3.OperationalError as e:
+                logging.error(f"{self.run_type} worker {worker_id} could not claim a job, backing off Error: {e}")
+                self.stop_event.wait(random.uniform(DB_ERROR_DELAY / 2, DB_ERROR_DELAY))
+                continue
+            if job is not None:
+                location_id, attempts = job
+                with self.running_lock:
+                    self.running[location_id] = worker_id
+                try:
+                    self._execute(location_id, attempts, worker_id)
+                finally:
+                    with self.running_lock:
+                        self.running.pop(location_id, None)
+                    with self.finished_changed:
+                        self.finished += 1
+                        self.finished_changed.notify_all()
+                continue
+
+            try:
+                _, next_attempt_at = self.db.fetch_run_progress(self.run_type, run_id)
+            except sqlite3.OperationalError as e:
+                logging.error(f"{self.run_type} worker {worker_id} could not read the run's progress Error: {e}")
+                self.stop_event.wait(random.uniform(DB_ERROR_DELAY / 2, DB_ERROR_DELAY))
+                continue
+            if next_attempt_at is None or not wait_for_retries:
+                return
+            # a job finishing here may have been the last one or scheduled a retry that is due sooner
+            with self.finished_changed:
+                self.finished_changed.wait_for(
+                    lambda: self.finished != finished or self.stop_event.is_set(),
+                    min(max(next_attempt_at - time.time(), 0.05), MAX_IDLE),
+                )
+
+    def _finish(self, location_id, worker_id, state, error=None, next_attempt_at=0):
+        """
+        finish_job, retried when the database is locked. Returns None when the result couldn't be recorded,
+        the job's lease then expires and the job is claimed again.
+        """
+        for attempt in range(1, DB_RETRIES + 1):
+            try:
+                return self.db.finish_job(self.run_type, location_id, worker_id, state, error, next_attempt_at)
+            except sqlite3.OperationalError as e:
+                logging.error(
+                    f"{self.run_type} job for Location ID: {location_id} could not be recorded as {state} "
+                    f"(attempt {attempt}/{DB_RETRIES}) Error: {e}"
+                )
+                if attempt < DB_RETRIES:
+                    time.sleep(random.uniform(DB_ERROR_DELAY / 2, DB_ERROR_DELAY) * attempt)
+        return None
+
+    def _execute(self, location_id, attempts, worker_id):
+        # claims of jobs whose worker died count as attempts too, so a job that kills its process gives up
+        if attempts > self.max_attempts:
+            self._fail(location_id, worker_id, PermanentJobError("lease expired on every attempt"))
+            return
+        try:
+            self.handler(location_id)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if isinstance(e, PermanentJobError) or attempts >= self.max_attempts:
+                self._fail(location_id, worker_id, e)
+                return
+            delay = self.backoff_delay(attempts)
+            print(f"{self.run_type} job for Location ID: {location_id} retrying in {delay:.0f}s Error: {error}")
+            self._finish(location_id, worker_id, "retry", error, time.time() + delay)
+            return
+        if self._finish(location_id, worker_id, "done") is False:
+            logging.error(f"{self.run_type} job for Location ID: {location_id} finished after its lease was lost")
+
+    def _fail(self, location_id, worker_id, e):
+        """marks the job failed for good and calls on_failure, the only place a job is given up on"""
+        error = f"{type(e).__name__}: {e}"
+        logging.error(f"{self.run_type} job failed for Location ID: {location_id} Error: {error}")
+        self._finish(location_id, worker_id, "failed", error)
+        if self.on_failure:
+            try:
+                self.on_failure(location_id, e)
+            except Exception as failure_error:
+                logging.error(f"{self.run_type} on_failure for Location ID: {location_id} Error: {failure_error}")
+
+    def stop(self):
+        """workers finish the job they are on and exit, unfinished jobs are resumed by the next run"""
+        self.stop_event.set()
+        with self.finished_changed:
+            self.finished_changed.notify_all()
@@ -43,6 +43,46 @@ class GoHighLevelConfig(Config):
     BASE_URL = os.environ.get("BASE_URL")
     CLIENT_ID = os.environ.get("CLIENT_ID")
     CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
+    REFRESH_WORKERS = int(os.environ.get("REFRESH_WORKERS", 8))
+    HTTP_POOL_SIZE = int(os.environ.get("GHL_HTTP_POOL_SIZE", 16))
+    # GHL allows 100 requests per 10 seconds per location, the global limit caps the whole process
+    RATE_PER_TOKEN = float(os.environ.get("GHL_RATE_PER_TOKEN", 10))
+    BURST_PER_TOKEN = int(os.environ.get("GHL_BURST_PER_TOKEN", 100))
+    GLOBAL_RATE = float(os.environ.get("GHL_GLOBAL_RATE", 50))
+    SYNC_WORKERS = int(os.environ.get("SYNC_WORKERS", 8))
+    # token refreshes requested within this many seconds after one completed get its result instead of a new exchange
+    REFRESH_COALESCE_SECONDS = float(os.environ.get("REFRESH_COALESCE_SECONDS", 30))
+    SERVICES_URL = os.environ.get("GHL_SERVICES_URL", "https://services.leadconnectorhq.com")
+    REST_V1_URL = os.environ.get("GHL_REST_V1_URL", "https://rest.gohighlevel.com/v1")
+
+
+class MatchConfig(Config):
+    # rows that match no phone, email or exact name fall back to fuzzy name matching when enabled, a wrong match
+    # is written to the sheet and never revisited, so it is off unless asked for
+    FUZZY_NAMES = os.environ.get("FUZZY_NAMES", "false").lower() in ("1", "true", "yes")
+    # lowest similarity (0-1) of the last name for a fuzzy match, the first name has to be equal
+    FUZZY_NAME_THRESHOLD = float(os.environ.get("FUZZY_NAME_THRESHOLD", 0.93))
+    # the best candidate must beat the runner-up by this much, otherwise the row is left unmatched
+    FUZZY_NAME_MARGIN = float(os.environ.get("FUZZY_NAME_MARGIN", 0.02))
+
+
+class JobConfig(Config):
+    # locations whose lead data sheets are updated at the same time
+    WORKERS = int(os.environ.get("LDS_WORKERS", 4))
+    MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+    # seconds before the first retry of a failed job, doubled on every further attempt up to MAX_RETRY_DELAY
+    RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", 30))
+    MAX_RETRY_DELAY = float(os.environ.get("JOB_MAX_RETRY_DELAY", 600))
+    # this process handles the retailers whose locationId hashes to SHARD_INDEX out of SHARD_COUNT shards
+    SHARD_INDEX = int(os.environ.get("SHARD_INDEX", 0))
+    SHARD_COUNT = int(os.environ.get("SHARD_COUNT", 1))
+    # seconds a claimed job or retailer stays reserved without a heartbeat before another process may take it
+    LEASE_SECONDS = float(os.environ.get("LEASE_SECONDS", 120))
+    # processes passing the same run key (e.g. the scheduled date) share one run whenever they start
+    RUN_KEY = os.environ.get("JOB_RUN_KEY") or None
+    # without a run key, a process starting this many seconds after the last run finished joins it instead of
+    # starting the work over
+    RUN_JOIN_SECONDS = float(os.environ.get("JOB_RUN_JOIN_SECONDS", 300))
 
 
 class ClickUpConfig(Config):
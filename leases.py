@@ -0,0 +1,98 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+import zlib
+
+from gohighlevel_oauth_demo_flask.keys import JobConfig
+
+# identifies this process in rgm_leases and rgm_jobs.claimed_by, unique across hosts sharing the database
+LEASE_OWNER = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def shard_of(location_id, shard_count):
+    """stable shard number of a location, the same in every process and on every host"""
+    return zlib.crc32(location_id.encode("utf-8")) % shard_count
+
+
+def in_shard(location_id, shard_index=JobConfig.SHARD_INDEX, shard_count=JobConfig.SHARD_COUNT):
+    return shard_count <= 1 or shard_of(location_id, shard_count) == shard_index
+
+
+def sharded_run_type(run_type, shard_index=JobConfig.SHARD_INDEX, shard_count=JobConfig.SHARD_COUNT):
+    """
+    Job run type of one shard, every shard keeps its own run in rgm_jobs so engines only ever claim
+    the locations of their shard. Unsharded processes all share the plain run type.
+    """
+    return run_type if shard_count <= 1 else f"{run_type}:{shard_index}/{shard_count}"
+
+
+class Heartbeat:
+    """calls beat() every interval seconds on a daemon thread until stopped"""
+
+    def __init__(self, interval, beat, name="heartbeat"):
+        self.interval = interval
+        self.beat = beat
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                logging.error(f"{self.thread.name} failed: {e}")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+class Lease:
+    """
+    A named lease in rgm_leases, kept alive by a heartbeat for as long as it is held so long work
+    doesn't lose it, and left to expire after lease_seconds if the process dies.
+
+    from oauth_flask.leases import Lease
+
+    lease = Lease(DB, f"contacts:{location_id}")
+    if lease.acquire():
+        with lease:
+            sync_location_contacts(location_id, api_key)
+    """
+
+    def __init__(self, db, name, owner=LEASE_OWNER, lease_seconds=JobConfig.LEASE_SECONDS):
+        self.db = db
+        self.name = name
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.heartbeat = None
+
+    def acquire(self):
+        """returns False while another owner holds the lease"""
+        if not self.db.acquire_lease(self.name, self.owner, self.lease_seconds):
+            return False
+        self.heartbeat = Heartbeat(self.lease_seconds / 3, self._renew, name=f"lease-{self.name}").start()
+        return True
+
+    def _renew(self):
+        if not self.db.acquire_lease(self.name, self.owner, self.lease_seconds):
+            logging.error(f"Lease {self.name} was taken over by another owner")
+
+    def release(self):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+        return self.db.release_lease(self.name, self.owner)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,290 @@
+import bisect
+import functools
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+# seconds, upper bounds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metric:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(labelname, "")) for labelname in self.labelnames)
+
+    def _labels(self, key, extra=""):
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def samples(self):
+        return [(self.name + self._labels(key), value) for key, value in sorted(self.snapshot().items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per bucket counts (last one is +Inf), sum, count]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+
+    def samples(self):
+        samples = []
+        for key, (counts, total, count) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((self.name + "_bucket" + self._labels(key, f'le="{le}"'), cumulative))
+            samples.append((self.name + "_sum" + self._labels(key), total))
+            samples.append((self.name + "_count" + self._labels(key), count))
+        return samples
+
+    def quantile(self, q, counts):
+        """estimates quantile q from bucket counts as the upper bound of the bucket it falls in"""
+        total = sum(counts)
+        if not total:
+            return None
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            if cumulative >= q * total:
+                return bound
+        return float("inf")
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at, **self.labels)
+
+
+class Registry:
+    """
+    Holds the process's metrics and renders them in the Prometheus text format.
+    Collectors are callables returning [(name, kind, documentation, {label: value}, value)] for numbers
+    kept elsewhere (rate limiter, circuit breaker counters), read at scrape time.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name} {_format(value)}" for name, value in metric.samples())
+
+        # the samples of a metric have to be listed together, collectors may yield them interleaved
+        families = {}
+        for collector in self.collectors:
+            for name, kind, documentation, labels, value in collector():
+                family = families.setdefault(name, [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"])
+                label_text = ",".join(f'{label}="{_escape(str(text))}"' for label, text in labels.items())
+                family.append(f"{name}{{{label_text}}} {_format(value)}" if label_text else f"{name} {_format(value)}")
+        for family in families.values():
+            lines.extend(family)
+        return "\n".join(lines) + "\n"
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+UPSTREAM_CALLS = REGISTRY.register(
+    Counter("rgm_upstream_calls_total", "Calls made to upstream APIs, retries included", ["api", "endpoint"])
+)
+UPSTREAM_ERRORS = REGISTRY.register(
+    Counter(
+        "rgm_upstream_errors_total",
+        "Upstream calls that raised or returned an error status",
+        ["api", "endpoint", "status"],
+    )
+)
+UPSTREAM_RETRIES = REGISTRY.register(
+    Counter("rgm_upstream_retries_total", "Throttled upstream calls that were retried", ["api", "endpoint"])
+)
+UPSTREAM_LATENCY = REGISTRY.register(
+    Histogram("rgm_upstream_call_seconds", "Latency of single upstream calls", ["api", "endpoint"])
+)
+SQLITE_CALLS = REGISTRY.register(Counter("rgm_sqlite_calls_total", "SQLiteDB method calls", ["method"]))
+SQLITE_ERRORS = REGISTRY.register(Counter("rgm_sqlite_errors_total", "SQLiteDB method calls that raised", ["method"]))
+SQLITE_LATENCY = REGISTRY.register(
+    Histogram("rgm_sqlite_call_seconds", "Latency of SQLiteDB method calls, writer queueing included", ["method"])
+)
+ROWS_PROCESSED = REGISTRY.register(
+    Counter("rgm_rows_processed_total", "Rows handled per location", ["kind", "location"])
+)
+
+ID_SEGMENT = re.compile(r"^(?=.*\d)[A-Za-z0-9_-]{8,}$")
+
+
+@functools.lru_cache(maxsize=4096)
+def endpoint_label(url):
+    """path of a URL with its query dropped and id-like segments replaced, so ids don't become label values"""
+    path = urlsplit(url).path or "/"
+    return "/".join(":id" if ID_SEGMENT.match(segment) else segment for segment in path.split("/"))
+
+
+def instrument_methods(cls):
+    """class decorator recording count, errors and latency of every public method of a SQLiteDB-like class"""
+    for name, attribute in list(vars(cls).items()):
+        if name.startswith("_") or not callable(attribute) or isinstance(attribute, (staticmethod, classmethod, type)):
+            continue
+        setattr(cls, name, _instrumented(attribute))
+    return cls
+
+
+def _instrumented(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            SQLITE_ERRORS.inc(method=name)
+            raise
+        finally:
+            SQLITE_CALLS.inc(method=name)
+            SQLITE_LATENCY.observe(time.perf_counter() - started_at, method=name)
+
+    return wrapper
+
+
+def snapshot():
+    """current values of every metric, pass it to summary() to get what happened since"""
+    return {metric.name: metric.snapshot() for metric in REGISTRY.metrics}
+
+
+def summary(since=None):
+    """
+    Returns what happened since the snapshot since (or since start-up) as
+    {"upstream": {"api endpoint": {...}}, "sqlite": {"method": {...}}, "rows": {"kind": rows}},
+    the call entries holding calls, errors, seconds and the estimated p50 and p99 latency.
+    """
+    since = since or {}
+
+    def calls(histogram, errors, label):
+        before = since.get(histogram.name, {})
+        error_counts = {}
+        for key, count in errors.snapshot().items():
+            previous = since.get(errors.name, {}).get(key, 0)
+            error_counts[key[: len(histogram.labelnames)]] = error_counts.get(key[: len(histogram.labelnames)], 0) + (
+                count - previous
+            )
+
+        result = {}
+        for key, (counts, total, count) in histogram.snapshot().items():
+            previous_counts, previous_total, previous_count = before.get(key, ([0] * len(counts), 0.0, 0))
+            count -= previous_count
+            if not count:
+                continue
+            counts = [now - then for now, then in zip(counts, previous_counts)]
+            result[label(key)] = {
+                "calls": count,
+                "errors": error_counts.get(key, 0),
+                "seconds": round(total - previous_total, 3),
+                "p50": histogram.quantile(0.5, counts),
+                "p99": histogram.quantile(0.99, counts),
+            }
+        return result
+
+    rows = {}
+    for (kind, _), count in ROWS_PROCESSED.snapshot().items():
+        rows[kind] = rows.get(kind, 0) + count
+    for (kind, _), count in since.get(ROWS_PROCESSED.name, {}).items():
+        rows[kind] = rows.get(kind, 0) - count
+
+    return {
+        "upstream": calls(UPSTREAM_LATENCY, UPSTREAM_ERRORS, " ".join),
+        "sqlite": calls(SQLITE_LATENCY, SQLITE_ERRORS, lambda key: key[0]),
+        "rows": {kind: count for kind, count in rows.items() if count},
+    }
+
+
+def log_summary(title, since=None):
+    """prints and logs the summary() of a batch job and returns it"""
+    result = summary(since)
+    lines = [f"{title} metrics"]
+    for section in ("upstream", "sqlite"):
+        for name, entry in sorted(result[section].items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(
+                f"  {section} {name}: {entry['calls']} calls, {entry['errors']} errors, {entry['seconds']}s, "
+                f"p50 <= {entry['p50']}s, p99 <= {entry['p99']}s"
+            )
+    lines.extend(f"  rows {kind}: {count}" for kind, count in sorted(result["rows"].items()))
+    message = "\n".join(lines)
+    print(message)
+    logging.info(message)
+    return result
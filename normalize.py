@@ -0,0 +1,92 @@
+import functools
+import re
+
+# country calling code assumed for numbers written without one
+DEFAULT_COUNTRY_CODE = "1"
+# distinct raw values remembered by each normalizer
+NORMALIZER_CACHE_SIZE = 65536
+
+EXTENSION = re.compile(r"\s*(?:ext\.?|extension|x|#)\s*\d+\s*$", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def normalize_phone(phone_number):
+    """
+    Returns the E.164 form of a phone number or None when it can't be read as one.
+    "(910) 733-9541", "910.733.9541", "9107339541", "1-910-733-9541", "19107339541" and "+1 910 733 9541"
+    all become "+19107339541", numbers with a "+" or "00" prefix keep their own country code,
+    extensions ("x12", "ext. 12") are dropped.
+    """
+    if not phone_number:
+        return None
+    phone_number = EXTENSION.sub("", str(phone_number).strip())
+    digits = "".join(c for c in phone_number if c.isdigit())
+
+    if phone_number.startswith("+"):
+        pass
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    elif len(digits) == 10:
+        digits = DEFAULT_COUNTRY_CODE + digits
+    elif not (len(digits) == 11 and digits.startswith(DEFAULT_COUNTRY_CODE)):
+        return None
+
+    # E.164 allows at most 15 digits, anything under 8 is not a full number
+    if not 8 <= len(digits) <= 15:
+        return None
+    return "+" + digits
+
+
+@functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def normalize_email(email):
+    if not email:
+        return None
+    return str(email).strip().lower() or None
+
+
+@functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def normalize_name(name):
+    """lowercased with surrounding whitespace removed and inner runs of whitespace collapsed to one space"""
+    if not name:
+        return None
+    return " ".join(str(name).lower().split()) or None
+
+
+def contact_match_keys(phone_number, email, first_name, last_name):
+    """returns the (phone_key, email_key, first_name_key, last_name_key) a contact is matched on"""
+    return normalize_phone(phone_number), normalize_email(email), normalize_name(first_name), normalize_name(last_name)
+
+
+SOUNDEX_CODES = {
+    **dict.fromkeys("bfpv", "1"),
+    **dict.fromkeys("cgjkqsxz", "2"),
+    **dict.fromkeys("dt", "3"),
+    "l": "4",
+    **dict.fromkeys("mn", "5"),
+    "r": "6",
+}
+
+
+@functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def soundex(name):
+    """American Soundex code of a name ("smith" and "smyth" -> "S530"), None when it has no letters"""
+    letters = [c for c in (name or "").lower() if "a" <= c <= "z"]
+    if not letters:
+        return None
+    code = letters[0].upper()
+    previous = SOUNDEX_CODES.get(letters[0], "")
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES.get(letter, "")
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        # h and w don't separate letters with the same code, vowels do
+        if letter not in "hw":
+            previous = digit
+    return code.ljust(4, "0")
+
+
+def name_block_key(last_name):
+    """blocking key fuzzy name matching compares rows within, the Soundex code of the last name"""
+    return soundex(normalize_name(last_name))
@@ -0,0 +1,237 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from gohighlevel_oauth_demo_flask.keys import GoHighLevelConfig
+from gohighlevel_oauth_demo_flask.metrics import (
+    REGISTRY,
+    UPSTREAM_CALLS,
+    UPSTREAM_ERRORS,
+    UPSTREAM_LATENCY,
+    UPSTREAM_RETRIES,
+)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Holds up to capacity tokens and refills at rate tokens per second.
+    acquire() blocks until enough tokens are available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens=1):
+        """takes tokens from the bucket, sleeping as long as needed, and returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class KeyedRateLimiter:
+    """
+    One token bucket per key (e.g. per access token) plus an optional global bucket shared by every key.
+    """
+
+    def __init__(self, rate, capacity=None, global_rate=None, global_capacity=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.global_bucket = TokenBucket(global_rate, global_capacity) if global_rate else None
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, key):
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.rate, self.capacity)
+            return self.buckets[key]
+
+    def acquire(self, key=None):
+        waited = 0.0
+        if key is not None:
+            waited += self.bucket(key).acquire()
+        if self.global_bucket:
+            waited += self.global_bucket.acquire()
+        return waited
+
+
+def _status_code(obj):
+    """pulls an HTTP status code off a requests response, a gspread APIError or anything carrying a response"""
+    response = getattr(obj, "response", obj)
+    status_code = getattr(response, "status_code", None)
+    if status_code is None and obj is not None and getattr(obj, "args", None) and isinstance(obj.args[0], dict):
+        status_code = obj.args[0].get("code")
+    return status_code
+
+
+def _retry_after(obj):
+    """seconds to wait from a Retry-After header given either as delta-seconds or an HTTP date"""
+    response = getattr(obj, "response", obj)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class APIRateLimiter:
+    """
+    Rate limiting and retry policy for one upstream API.
+    Calls are paced by a global token bucket and optionally one bucket per key (access token).
+    Throttled calls (HTTP 429, either raised or returned) are retried up to max_retries times,
+    waiting for Retry-After when the API sends it and a jittered exponential backoff otherwise.
+    Every attempt is recorded in the upstream call metrics under the limiter's name and the endpoint.
+    """
+
+    def __init__(
+        self,
+        name,
+        rate=None,
+        capacity=None,
+        per_key_rate=None,
+        per_key_capacity=None,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=120.0,
+    ):
+        self.name = name
+        self.global_bucket = TokenBucket(rate, capacity) if rate else None
+        self.keyed = KeyedRateLimiter(per_key_rate, per_key_capacity) if per_key_rate else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counters = {"calls": 0, "throttled": 0, "retries": 0, "gave_up": 0, "wait_seconds": 0.0}
+        self.lock = threading.Lock()
+
+    def _count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def acquire(self, key=None):
+        waited = 0.0
+        if self.keyed and key is not None:
+            waited += self.keyed.acquire(key)
+        if self.global_bucket:
+            waited += self.global_bucket.acquire()
+        self._count("wait_seconds", waited)
+        return waited
+
+    def backoff_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _observe(self, endpoint, started_at, error_status=None):
+        UPSTREAM_CALLS.inc(api=self.name, endpoint=endpoint)
+        UPSTREAM_LATENCY.observe(time.perf_counter() - started_at, api=self.name, endpoint=endpoint)
+        if error_status is not None:
+            UPSTREAM_ERRORS.inc(api=self.name, endpoint=endpoint, status=error_status)
+
+    def call(self, fn, *args, key=None, endpoint=None, **kwargs):
+        """
+        Calls fn(*args, **kwargs) within the limits. After max_retries throttled attempts the last
+        429 response is returned, or the last 429 exception is re-raised, so callers keep their own handling.
+        endpoint labels the call in the metrics, the function's name by default.
+        """
+        endpoint = endpoint or getattr(fn, "__name__", "call")
+        attempt = 0
+        while True:
+            self.acquire(key)
+            self._count("calls")
+            started_at = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                status_code = _status_code(e)
+                self._observe(endpoint, started_at, status_code or type(e).__name__)
+                if status_code != 429:
+                    raise
+                throttled = e
+            else:
+                status_code = _status_code(result)
+                self._observe(endpoint, started_at, status_code if status_code and status_code >= 400 else None)
+                if status_code != 429:
+                    return result
+                throttled = None
+
+            self._count("throttled")
+            if attempt >= self.max_retries:
+                self._count("gave_up")
+                if throttled is not None:
+                    raise throttled
+                return result
+
+            delay = self.backoff_delay(attempt, _retry_after(throttled if throttled is not None else result))
+            self._count("retries")
+            UPSTREAM_RETRIES.inc(api=self.name, endpoint=endpoint)
+            self._count("wait_seconds", delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+# documented quotas: Sheets 60 requests per minute per user, GHL 100 requests per 10 seconds per location,
+# ClickUp 100 requests per minute per token
+RATE_LIMITERS = {
+    "sheets": APIRateLimiter("sheets", rate=1.0, capacity=60),
+    "ghl_v1": APIRateLimiter(
+        "ghl_v1",
+        rate=GoHighLevelConfig.GLOBAL_RATE,
+        per_key_rate=GoHighLevelConfig.RATE_PER_TOKEN,
+        per_key_capacity=GoHighLevelConfig.BURST_PER_TOKEN,
+    ),
+    "ghl_v2": APIRateLimiter(
+        "ghl_v2",
+        rate=GoHighLevelConfig.GLOBAL_RATE,
+        per_key_rate=GoHighLevelConfig.RATE_PER_TOKEN,
+        per_key_capacity=GoHighLevelConfig.BURST_PER_TOKEN,
+    ),
+    "clickup": APIRateLimiter("clickup", rate=100 / 60, capacity=100),
+}
+
+
+def throttle_stats():
+    """returns the counters of every API rate limiter keyed by API name"""
+    return {name: limiter.stats() for name, limiter in RATE_LIMITERS.items()}
+
+
+# metric name, APIRateLimiter counter, help text
+RATE_LIMITER_METRICS = [
+    ("rgm_rate_limiter_throttled_total", "throttled", "Responses throttled with HTTP 429"),
+    ("rgm_rate_limiter_gave_up_total", "gave_up", "Calls still throttled after every retry"),
+    ("rgm_rate_limiter_wait_seconds_total", "wait_seconds", "Seconds spent waiting for tokens or backoff"),
+]
+
+
+@REGISTRY.add_collector
+def _rate_limiter_metrics():
+    stats = throttle_stats()
+    for metric_name, counter, documentation in RATE_LIMITER_METRICS:
+        for name, counters in stats.items():
+            yield metric_name, "counter", documentation, {"api": name}, counters[counter]
@@ -0,0 +1,103 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from requests.exceptions import JSONDecodeError, RequestException
+
+from gohighlevel_oauth_demo_flask.keys import GoHighLevelConfig
+from gohighlevel_oauth_demo_flask.circuit_breaker import CircuitOpenError
+from gohighlevel_oauth_demo_flask.utils import DB, RefreshTokenError, refresh_location
+
+# refresh this many seconds before a token expires
+REFRESH_MARGIN = 15 * 60
+# wait this long before retrying a location whose refresh failed
+RETRY_DELAY = 5 * 60
+# never sleep longer than this between checks so newly authorised locations get picked up
+MAX_IDLE = 60
+
+
+class TokenRefreshScheduler:
+    """
+    Keeps a min-heap of (refresh_at, locationId) built from api_data.expires_at and refreshes
+    each location a configurable margin before its token expires.
+
+    from oauth_flask.scheduler import TokenRefreshScheduler
+
+    scheduler = TokenRefreshScheduler(refresh_margin=600)
+    scheduler.run_forever()
+    """
+
+    def __init__(self, refresh_margin=REFRESH_MARGIN, max_workers=GoHighLevelConfig.REFRESH_WORKERS):
+        self.refresh_margin = refresh_margin
+        self.max_workers = max(1, max_workers)
+        self.heap = []
+        self.scheduled = set()
+        self.stop_event = threading.Event()
+
+    def load(self):
+        """adds every location in api_data that is not already scheduled, tokens without an expiry are due now"""
+        for location_id, expires_at in DB.fetch_token_expiries():
+            if location_id in self.scheduled:
+                continue
+            self._schedule(location_id, (expires_at or 0) - self.refresh_margin)
+        return len(self.heap)
+
+    def _schedule(self, location_id, refresh_at):
+        heapq.heappush(self.heap, (refresh_at, location_id))
+        self.scheduled.add(location_id)
+
+    def next_refresh_at(self):
+        return self.heap[0][0] if self.heap else None
+
+    def run_pending(self, now=None):
+        """
+        Refreshes every location that is due and reschedules it from its new expiry.
+        Returns {locationId: {"status": "ok" | "error" | "skipped", "error": str | None}}
+        """
+        now = time.time() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, location_id = heapq.heappop(self.heap)
+            self.scheduled.discard(location_id)
+            due.append(location_id)
+
+        results = {}
+        if not due:
+            return results
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(due))) as executor:
+            futures = {executor.submit(self._refresh_location, location_id): location_id for location_id in due}
+            for future in as_completed(futures):
+                location_id = futures[future]
+                try:
+                    expires_at = future.result()
+                    self._schedule(location_id, expires_at - self.refresh_margin)
+                    results[location_id] = {"status": "ok", "error": None}
+                except CircuitOpenError as e:
+                    # the token breaker is open, look again once the location may be probed
+                    self._schedule(location_id, time.time() + RETRY_DELAY)
+                    results[location_id] = {"status": "skipped", "error": str(e)}
+                except (JSONDecodeError, RefreshTokenError, RequestException, LookupError) as e:
+                    logging.error(f"Error refreshing token for Location ID: {location_id} Error: {e}")
+                    self._schedule(location_id, time.time() + RETRY_DELAY)
+                    results[location_id] = {"status": "error", "error": str(e)}
+        return results
+
+    def _refresh_location(self, location_id):
+        """refreshes one location and returns the stored expires_at of the new token"""
+        return refresh_location(location_id) or time.time()
+
+    def run_forever(self):
+        """runs until stop() is called, sleeping until the next token is due"""
+        while not self.stop_event.is_set():
+            self.load()
+            self.run_pending()
+            next_refresh_at = self.next_refresh_at()
+            wait = MAX_IDLE if next_refresh_at is None else next_refresh_at - time.time()
+            self.stop_event.wait(min(max(wait, 0), MAX_IDLE))
+        return True
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,221 @@
+import threading
+from collections import OrderedDict
+
+from gohighlevel_oauth_demo_flask.rate_limit import RATE_LIMITERS
+
+SHEETS_LIMITER = RATE_LIMITERS["sheets"]
+
+# sheets a SheetSession keeps before dropping the least recently used one, an evicted sheet is reopened on next use
+MAX_SESSION_SHEETS = 32
+
+
+def column_letter(column_index):
+    """0-based column index to A1 column letters: 0 -> A, 25 -> Z, 26 -> AA"""
+    letters = ""
+    column_number = column_index + 1
+    while column_number:
+        column_number, remainder = divmod(column_number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def column_range(column_index, first_row, last_row):
+    """A1 range of a single column between two 1-based rows"""
+    letter = column_letter(column_index)
+    return f"{letter}{first_row}:{letter}{last_row}"
+
+
+def changed_runs(old_values, new_values):
+    """
+    Yields (offset, values) for every contiguous run of new_values that differs from old_values.
+    Cells past the end of old_values count as empty, None counts as an empty string.
+    """
+    run_start = None
+    for offset, value in enumerate(new_values):
+        value = "" if value is None else str(value)
+        old = old_values[offset] if offset < len(old_values) else ""
+        if value != old:
+            if run_start is None:
+                run_start = offset
+        elif run_start is not None:
+            yield run_start, new_values[run_start:offset]
+            run_start = None
+    if run_start is not None:
+        yield run_start, new_values[run_start:]
+
+
+def normalize_header(header):
+    return header.lower().rstrip()
+
+
+class CachedWorksheet:
+    """
+    Wraps a gspread Worksheet so its values are read from Sheets at most once until the next write.
+    Either the whole grid (get_all_values) or only the needed columns (get_projected_values) can be read,
+    column reads fetch the header row first and then batch-get just the required column ranges.
+    Reads and writes go through the sheets rate limiter, anything else is passed to the worksheet.
+    """
+
+    def __init__(self, worksheet, url):
+        self.worksheet = worksheet
+        self.url = url
+        self.values = None
+        self.header_row = None
+        # 0-based column index -> values from row 2 down, trailing empty cells trimmed
+        self.columns = {}
+        self.lock = threading.RLock()
+
+    def get_all_values(self):
+        with self.lock:
+            if self.values is None:
+                self.values = SHEETS_LIMITER.call(self.worksheet.get_all_values)
+            return self.values
+
+    def get_header_row(self):
+        with self.lock:
+            if self.values is not None:
+                return self.values[0] if self.values else []
+            if self.header_row is None:
+                self.header_row = SHEETS_LIMITER.call(self.worksheet.row_values, 1)
+            return self.header_row
+
+    def headers_mapping(self):
+        """normalized header -> 0-based column index"""
+        return {normalize_header(header): index for index, header in enumerate(self.get_header_row())}
+
+    def get_columns(self, column_indexes):
+        """returns {column index: values from row 2 down}, fetching the columns not cached yet in one batch_get"""
+        with self.lock:
+            if self.values is not None:
+                return {
+                    index: [row[index] if index < len(row) else "" for row in self.values[1:]]
+                    for index in column_indexes
+                }
+
+            missing = [index for index in column_indexes if index not in self.columns]
+            if missing:
+                ranges = [f"{column_letter(index)}2:{column_letter(index)}" for index in missing]
+                value_ranges = SHEETS_LIMITER.call(self.worksheet.batch_get, ranges, major_dimension="COLUMNS")
+                for index, value_range in zip(missing, value_ranges):
+                    self.columns[index] = list(value_range[0]) if value_range else []
+            return {index: self.columns[index] for index in column_indexes}
+
+    def get_projected_values(self, headers):
+        """
+        Returns a compact grid shaped like get_all_values but holding only the requested headers that exist,
+        in the requested order, with the normalized header names as its first row.
+        """
+        mapping = self.headers_mapping()
+        present = [header for header in headers if header in mapping]
+        columns = self.get_columns([mapping[header] for header in present])
+        values = [columns[mapping[header]] for header in present]
+        row_count = max((len(column) for column in values), default=0)
+        padded = [column + [""] * (row_count - len(column)) for column in values]
+        return [present] + [list(row) for row in zip(*padded)]
+
+    def invalidate(self):
+        with self.lock:
+            self.values = None
+            self.header_row = None
+            self.columns = {}
+
+    def batch_update(self, data, **kwargs):
+        try:
+            return SHEETS_LIMITER.call(self.worksheet.batch_update, data, **kwargs)
+        finally:
+            self.invalidate()
+
+    def insert_cols(self, values, col=1, **kwargs):
+        try:
+            return SHEETS_LIMITER.call(self.worksheet.insert_cols, values, col=col, **kwargs)
+        finally:
+            self.invalidate()
+
+    def update_columns(self, columns, first_row=2):
+        """
+        Writes {0-based column index: values} starting at first_row, sending only the runs of cells that differ
+        from the cached values in one batch_update. No request is made when nothing changed.
+        Returns the number of cells written.
+        """
+        current = self.get_columns(list(columns))
+        data = []
+        cells = 0
+        for column_index, values in columns.items():
+            old_values = current[column_index][first_row - 2 :]
+            for offset, run in changed_runs(old_values, values):
+                start = first_row + offset
+                data.append(
+                    {
+                        "range": column_range(column_index, start, start + len(run) - 1),
+                        "values": [["" if value is None else value] for value in run],
+                    }
+                )
+                cells += len(run)
+
+        if data:
+            self.batch_update(data)
+        return cells
+
+    def __getattr__(self, name):
+        return getattr(self.worksheet, name)
+
+
+class SheetSession:
+    """
+    Per-run cache of lead data sheets keyed by URL. Each sheet is opened once per run and its
+    values are read once until a write through the returned CachedWorksheet invalidates them.
+    At most max_sheets sheets are kept, passes that are done with a sheet should release it.
+
+    from oauth_flask.sheets import SheetSession
+
+    session = SheetSession(google_client)
+    lds_sheet = session.open(lds_link)
+    worksheet_values = lds_sheet.get_all_values()
+    session.release(lds_link)
+    """
+
+    def __init__(self, google_client, max_sheets=MAX_SESSION_SHEETS):
+        self.google_client = google_client
+        self.max_sheets = max_sheets
+        self.worksheets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def open(self, url, index=0):
+        """returns the cached worksheet at index of the spreadsheet at url, opening it on first use"""
+        key = (url, index)
+        with self.lock:
+            cached = self.worksheets.get(key)
+            if cached is not None:
+                self.worksheets.move_to_end(key)
+                return cached
+
+        spreadsheet = SHEETS_LIMITER.call(self.google_client.open_by_url, url)
+        worksheet = CachedWorksheet(SHEETS_LIMITER.call(spreadsheet.get_worksheet, index), url)
+        with self.lock:
+            worksheet = self.worksheets.setdefault(key, worksheet)
+            self.worksheets.move_to_end(key)
+            while len(self.worksheets) > self.max_sheets:
+                self.worksheets.popitem(last=False)
+            return worksheet
+
+    def release(self, url, index=None):
+        """drops the sheet at url (only its worksheet at index when given) and its values from the session"""
+        with self.lock:
+            for key in [key for key in self.worksheets if key[0] == url and index in (None, key[1])]:
+                del self.worksheets[key]
+
+    def invalidate(self, url=None):
+        """drops cached values for url, or for every sheet when url is None"""
+        with self.lock:
+            worksheets = [worksheet for (key, _), worksheet in self.worksheets.items() if url in (None, key)]
+        for worksheet in worksheets:
+            worksheet.invalidate()
+
+    def close(self):
+        with self.lock:
+            self.worksheets.clear()
+
+
+def sheet_session(google_client):
+    """returns google_client when it already is a SheetSession, otherwise a new session around it"""
+    return google_client if isinstance(google_client, SheetSession) else SheetSession(google_client)
@@ -0,0 +1,78 @@
+import threading
+import time
+from concurrent.futures import Future
+
+# completed calls kept before expired ones are swept out
+MAX_REMEMBERED = 1024
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: the first caller runs the function, every caller that
+    arrives while it is in flight waits for it and gets the same result or exception. With ttl, a successful
+    result is also handed to callers arriving up to ttl seconds after it completed.
+
+    from oauth_flask.single_flight import SingleFlight
+
+    flights = SingleFlight()
+    expires_at = flights.do(location_id, refresh, location_id)
+    """
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        # key -> (future, monotonic time it completed or None while in flight)
+        self.calls = {}
+        self.counters = {"calls": 0, "executed": 0, "shared": 0}
+        self.lock = threading.Lock()
+
+    def _reusable(self, call, now):
+        future, completed_at = call
+        return completed_at is None or now - completed_at < self.ttl
+
+    def do(self, key, fn, *args, **kwargs):
+        now = time.monotonic()
+        with self.lock:
+            self.counters["calls"] += 1
+            call = self.calls.get(key)
+            if call is not None and self._reusable(call, now):
+                self.counters["shared"] += 1
+                leader = False
+                future = call[0]
+            else:
+                self.counters["executed"] += 1
+                leader = True
+                future = Future()
+                self.calls[key] = (future, None)
+                if len(self.calls) > MAX_REMEMBERED:
+                    self.calls = {k: c for k, c in self.calls.items() if self._reusable(c, now)}
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            # failures are never handed to later callers
+            with self.lock:
+                self.calls.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            if self.ttl > 0:
+                self.calls[key] = (future, time.monotonic())
+            else:
+                self.calls.pop(key, None)
+        future.set_result(result)
+        return result
+
+    def forget(self, key):
+        """drops a completed result so the next call for key runs again, a call in flight is unaffected"""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None and call[1] is not None:
+                del self.calls[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
@@ -1,20 +1,339 @@
+import contextlib
+import functools
+import queue
 import sqlite3
 import threading
+import time
+import uuid
+from concurrent.futures import Future
 from typing import Dict
 import os
+from cachetools import TLRUCache
 
+from gohighlevel_oauth_demo_flask.fuzzy_match import best_name_match
+from gohighlevel_oauth_demo_flask.metrics import instrument_methods
+from gohighlevel_oauth_demo_flask.normalize import contact_match_keys, name_block_key
 
+# maximum number of access tokens kept in memory, least recently used are evicted first
+TOKEN_CACHE_SIZE = 1024
+# stop serving a cached token this many seconds before it expires
+TOKEN_CACHE_MARGIN = 60
+# maximum number of queued writes the writer thread commits in one transaction
+WRITER_BATCH_SIZE = 256
+
+# pragmas applied to every connection, override any of them with SQLiteDB(storage_profile={...})
+DEFAULT_STORAGE_PROFILE = {
+    # readers never block the writer and the writer never blocks readers
+    "journal_mode": "WAL",
+    # safe with WAL, only the last commits can be lost on power failure, not the database
+    "synchronous": "NORMAL",
+    # negative values are KiB, 64MB page cache per connection
+    "cache_size": -64000,
+    "mmap_size": 256 * 1024 * 1024,
+    # milliseconds to wait for a lock before raising "database is locked"
+    "busy_timeout": 30000,
+}
+
+
+def serialized_write(method):
+    """routes a SQLiteDB write method through the writer thread while one is running"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        writer = self.writer
+        if writer is None or writer.is_writer_thread():
+            return method(self, *args, **kwargs)
+        return writer.submit(method, self, *args, **kwargs).result()
+
+    return wrapper
+
+
+class SQLiteWriter:
+    """
+    Executes queued SQLiteDB writes on a single dedicated thread, so worker threads never contend
+    for the database write lock. Whatever is queued when the thread wakes up (up to max_batch writes)
+    is group-committed in one transaction, each write inside its own savepoint so a failing write
+    only rolls back itself. Futures resolve once their transaction is committed.
+    """
+
+    def __init__(self, db, max_batch=WRITER_BATCH_SIZE):
+        self.db = db
+        self.max_batch = max_batch
+        self.in_batch = False
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self.thread.start()
+
+    def is_writer_thread(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            items = [item for item in batch if item is not None]
+            if items:
+                self._commit_batch(items)
+            if len(items) != len(batch):
+                return
+
+    def _commit_batch(self, items):
+        conn = self.db.conn
+        results = []
+        self.in_batch = True
+        try:
+            # take the write lock up front: a deferred transaction that read first can't be upgraded once another
+            # process committed in between, and busy_timeout doesn't help with that
+            conn.execute("BEGIN IMMEDIATE")
+            for future, fn, args, kwargs in items:
+                conn.execute("SAVEPOINT queued_write")
+                try:
+                    results.append((future, fn(*args, **kwargs), None))
+                    conn.execute("RELEASE queued_write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO queued_write")
+                    conn.execute("RELEASE queued_write")
+                    results.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            for future, *_ in items:
+                future.set_exception(e)
+            return
+        finally:
+            self.in_batch = False
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _add_column(cursor, table_name, column_name, column_type):
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    if column_name not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+
+def _create_base_tables(cursor):
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS api_data (
+                userType TEXT,
+                companyId TEXT,
+                locationId TEXT PRIMARY KEY,
+                access_token TEXT,
+                token_type TEXT,
+                expires_in INTEGER,
+                refresh_token TEXT,
+                scope TEXT
+            );
+        """
+    )
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS rgm_retailers (
+                locationId TEXT PRIMARY KEY,
+                lds_link TEXT,
+                lds_updated INTEGER DEFAULT 0
+            );
+        """
+    )
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS rgm_contacts (
+                id TEXT PRIMARY KEY,
+                locationId TEXT,
+                email TEXT,
+                timezone TEXT,
+                firstName TEXT,
+                lastName TEXT,
+                contactName TEXT,
+                phone TEXT
+            );
+        """
+    )
+
+
+def _add_token_expiry(cursor):
+    # absolute unix timestamp the access token expires at
+    _add_column(cursor, "api_data", "expires_at", "INTEGER")
+
+
+def _create_sync_state_table(cursor):
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS rgm_sync_state (
+                locationId TEXT PRIMARY KEY,
+                last_synced_at TEXT,
+                last_date_updated TEXT
+            );
+        """
+    )
+
+
+def _create_lookup_indexes(cursor):
+    # supports attempt_contact_retrieval and fetch_location_contacts
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rgm_contacts_location_phone ON rgm_contacts (locationId, phone);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rgm_contacts_location_email ON rgm_contacts (locationId, email);")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rgm_contacts_location_name ON rgm_contacts (locationId, firstName, lastName);"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rgm_retailers_lds_updated ON rgm_retailers (lds_updated);")
+
+
+def _add_contact_match_keys(cursor):
+    # normalized phone (E.164), email and name keys the lead data sheet rows are matched on
+    for column_name in ("phone_key", "email_key", "first_name_key", "last_name_key"):
+        _add_column(cursor, "rgm_contacts", column_name, "TEXT")
+    cursor.execute("SELECT id, phone, email, firstName, lastName FROM rgm_contacts;")
+    cursor.executemany(
+        "UPDATE rgm_contacts SET phone_key = ?, email_key = ?, first_name_key = ?, last_name_key = ? WHERE id = ?;",
+        [(*contact_match_keys(*row[1:]), row[0]) for row in cursor.fetchall()],
+    )
+    # lookups no longer touch the raw columns
+    for index_name in ("phone", "email", "name"):
+        cursor.execute(f"DROP INDEX IF EXISTS idx_rgm_contacts_location_{index_name};")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rgm_contacts_location_phone_key ON rgm_contacts (locationId, phone_key);"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rgm_contacts_location_email_key ON rgm_contacts (locationId, email_key);"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rgm_contacts_location_name_key "
+        "ON rgm_contacts (locationId, first_name_key, last_name_key);"
+    )
+
+
+def _add_name_blocks(cursor):
+    # fuzzy name matching only compares a row against the contacts sharing its last name's Soundex code
+    _add_column(cursor, "rgm_contacts", "name_block", "TEXT")
+    cursor.execute("SELECT id, lastName FROM rgm_contacts;")
+    cursor.executemany(
+        "UPDATE rgm_contacts SET name_block = ? WHERE id = ?;",
+        [(name_block_key(last_name), contact_id) for contact_id, last_name in cursor.fetchall()],
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rgm_contacts_location_name_block ON rgm_contacts (locationId, name_block);"
+    )
+
+
+def _create_jobs_table(cursor):
+    # one job per location per run type, state is pending, running, retry, done or failed
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS rgm_jobs (
+                run_type TEXT NOT NULL,
+                locationId TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                created_at REAL,
+                started_at REAL,
+                finished_at REAL,
+                duration REAL,
+                last_error TEXT,
+                PRIMARY KEY (run_type, locationId)
+            );
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rgm_jobs_claim ON rgm_jobs (run_type, run_id, state, next_attempt_at);"
+    )
+
+
+def _add_leases(cursor):
+    # time-bounded claims that let processes on any host sharing the database split the retailers between them
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS rgm_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        """
+    )
+    # a running job whose lease expired is claimed again by any worker
+    _add_column(cursor, "rgm_jobs", "lease_expires_at", "REAL")
+
+
+def _create_failures_table(cursor):
+    # failure registry of the circuit breakers, open_until is 0 while the target is still called
+    cursor.execute(
+        """
+            CREATE TABLE IF NOT EXISTS rgm_failures (
+                kind TEXT NOT NULL,
+                target TEXT NOT NULL,
+                error_class TEXT,
+                error TEXT,
+                failures INTEGER NOT NULL DEFAULT 0,
+                first_failed_at REAL,
+                last_failed_at REAL,
+                open_until REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (kind, target)
+            );
+        """
+    )
+
+
+# schema migrations, applied in order, the database's PRAGMA user_version is the number already applied
+MIGRATIONS = [
+    _create_base_tables,
+    _add_token_expiry,
+    _create_sync_state_table,
+    _create_lookup_indexes,
+    _add_contact_match_keys,
+    _add_name_blocks,
+    _create_jobs_table,
+    _add_leases,
+    _create_failures_table,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+@instrument_methods
 class SQLiteDB:
     _instance = None
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
-            cls._instance = super(SQLiteDB, cls).__new__(cls, *args, **kwargs)
+            cls._instance = super(SQLiteDB, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self, db_name: str = "database.db"):
+    def __init__(self, db_name: str = "database.db", storage_profile: Dict = None):
+        # the instance is shared, keep the connections, cache and writer of the first initialisation
+        if getattr(self, "db_name", None) is not None:
+            if os.path.abspath(db_name) != self.db_name:
+                raise ValueError(f"SQLiteDB is already open on {self.db_name}, it can't switch to {db_name}")
+            return
+        self.writer = None
+        # start_writer() calls not matched by a stop_writer() yet
+        self.writer_users = 0
+        self.writer_lock = threading.Lock()
         self.local_storage = threading.local()
-        self.db_name = db_name
+        # absolute so connections opened after a chdir still use the same file
+        self.db_name = os.path.abspath(db_name)
+        self.storage_profile = {**DEFAULT_STORAGE_PROFILE, **(storage_profile or {})}
+        self.token_cache = TLRUCache(maxsize=TOKEN_CACHE_SIZE, ttu=self._token_ttu, timer=time.time)
+        self.token_cache_lock = threading.Lock()
         self._create_database()
 
     def _create_database(self):
@@ -22,37 +341,103 @@ class SQLiteDB:
             connection = sqlite3.connect(self.db_name)
             connection.close()
 
+    def start_writer(self):
+        """
+        Starts the single writer thread, writes from any other thread are queued onto it until stop_writer().
+        Calls nest: the thread keeps running until every start_writer() is matched by a stop_writer().
+        """
+        with self.writer_lock:
+            self.writer_users += 1
+            if self.writer is None:
+                self.writer = SQLiteWriter(self)
+            return self.writer
+
+    def stop_writer(self):
+        """matches one start_writer(), the last one drains the queued writes and stops the thread"""
+        with self.writer_lock:
+            if not self.writer_users:
+                return False
+            self.writer_users -= 1
+            if self.writer_users:
+                return True
+            writer, self.writer = self.writer, None
+        writer.stop()
+        return True
+
     @property
     def conn(self):
         if not hasattr(self.local_storage, "conn"):
-            self.local_storage.conn = sqlite3.connect(self.db_name)
-            self.create_table()
+            self.local_storage.conn = self._connect()
+            self.migrate()
         return self.local_storage.conn
 
-    def create_table(self):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            """
-                CREATE TABLE IF NOT EXISTS api_data (
-                    userType TEXT,
-                    companyId TEXT,
-                    locationId TEXT PRIMARY KEY,  
-                    access_token TEXT,
-                    token_type TEXT,
-                    expires_in INTEGER,
-                    refresh_token TEXT,
-                    scope TEXT
-                );
-            """
-        )
+    def _connect(self):
+        connection = sqlite3.connect(self.db_name, timeout=self.storage_profile["busy_timeout"] / 1000)
+        for pragma, value in self.storage_profile.items():
+            if value is not None:
+                connection.execute(f"PRAGMA {pragma} = {value}")
+        return connection
+
+    def _commit(self):
+        # inside a writer batch the writer commits the whole group at once
+        writer = self.writer
+        if writer is not None and writer.in_batch and writer.is_writer_thread():
+            return
         self.conn.commit()
 
+    @contextlib.contextmanager
+    def _immediate_transaction(self):
+        """
+        Runs a read-then-write method in one transaction that holds the write lock from the start, so no other
+        process can commit between its read and its write. Inside a writer batch the batch already holds the lock.
+        """
+        writer = self.writer
+        if self.conn.in_transaction or (writer is not None and writer.in_batch and writer.is_writer_thread()):
+            yield
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def schema_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        """
+        Brings the database file up to SCHEMA_VERSION by applying the pending MIGRATIONS in order.
+        Every migration is idempotent so files created before the schema was versioned upgrade cleanly.
+        """
+        if self.schema_version() >= SCHEMA_VERSION:
+            return False
+        cursor = self.conn.cursor()
+        # take the write lock first so concurrent connections apply each migration once
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            version = self.schema_version()
+            for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return True
+
+    def create_table(self):
+        return self.migrate()
+
+    @serialized_write
     def insert_or_update_token(self, data: Dict):
+        expires_at = int(time.time()) + int(data["expires_in"])
         cursor = self.conn.cursor()
         cursor.execute(
             """
-            INSERT INTO api_data (userType, companyId, locationId, access_token, token_type, expires_in, refresh_token, scope) 
-            VALUES (:userType, :companyId, :locationId, :access_token, :token_type, :expires_in, :refresh_token, :scope)
+            INSERT INTO api_data (userType, companyId, locationId, access_token, token_type, expires_in, refresh_token, scope, expires_at) 
+            VALUES (:userType, :companyId, :locationId, :access_token, :token_type, :expires_in, :refresh_token, :scope, :expires_at)
             ON CONFLICT(locationId) 
             DO UPDATE SET 
                 userType = excluded.userType,
@@ -61,7 +446,8 @@ class SQLiteDB:
                 token_type = excluded.token_type,
                 expires_in = excluded.expires_in,
                 refresh_token = excluded.refresh_token,
-                scope = excluded.scope
+                scope = excluded.scope,
+                expires_at = excluded.expires_at
             """,
             {
                 "userType": data["userType"],
@@ -72,12 +458,44 @@ class SQLiteDB:
                 "expires_in": data["expires_in"],
                 "refresh_token": data["refresh_token"],
                 "scope": data["scope"],
+                "expires_at": expires_at,
             },
         )
-        self.conn.commit()
+        self._commit()
+        self._cache_token(data["locationId"], data["access_token"], expires_at)
         print(f"Updated access token for locationId: {data['locationId']}")
         return True
 
+    @staticmethod
+    def _token_ttu(location_id, value, now):
+        # tokens stored before expires_at was tracked expire immediately, so they are never cached
+        expires_at = value[1]
+        return expires_at - TOKEN_CACHE_MARGIN if expires_at else now
+
+    def _cache_token(self, location_id, access_token, expires_at):
+        with self.token_cache_lock:
+            self.token_cache.pop(location_id, None)
+            self.token_cache[location_id] = (access_token, expires_at)
+
+    def get_access_token(self, location_id):
+        """Read-through cached lookup of a location's access token, returns None if the location has no token"""
+        with self.token_cache_lock:
+            cached = self.token_cache.get(location_id)
+        if cached:
+            return cached[0]
+
+        record = self.fetch_single_column("api_data", "access_token, expires_at", "locationId", location_id)
+        if not record:
+            return None
+        self._cache_token(location_id, record[0], record[1])
+        return record[0]
+
+    def fetch_token_expiries(self):
+        """Returns a list of (locationId, expires_at) tuples, expires_at is None for tokens stored before it was tracked"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT locationId, expires_at FROM api_data")
+        return cursor.fetchall()
+
     def fetch_all_records(self, table_name):
         cursor = self.conn.cursor()
         cursor.execute(f"SELECT * FROM {table_name}")
@@ -94,29 +512,23 @@ class SQLiteDB:
         return cursor.fetchone()
 
     def create_retailers_table(self):
-        query = """
-            CREATE TABLE IF NOT EXISTS rgm_retailers (
-                locationId TEXT PRIMARY KEY,
-                lds_link TEXT,
-                lds_updated INTEGER DEFAULT 0
-            );
-        """
-        cursor = self.conn.cursor()
-        cursor.execute(query)
-        self.conn.commit()
+        return self.migrate()
 
+    @serialized_write
     def insert_many_retailer_records(self, mds_data):
         # insert location id and mds_link into rgm_retailers table
         query = "INSERT INTO rgm_retailers (locationId, lds_link) VALUES (?, ?) ON CONFLICT (locationId) DO UPDATE SET lds_link = EXCLUDED.lds_link;"
         cursor = self.conn.cursor()
         cursor.executemany(query, mds_data)
-        self.conn.commit()
+        self._commit()
         print(f"Updated {cursor.rowcount} records in rgm_retailers table")
         return True
 
+    @serialized_write
     def insert_many_contacts(self, contact_data):
         # insert id", "locationId", "email","timezone", "firstName", "lastName", "contactName", and "phone" into the rgm_contacts table
-        query = "INSERT INTO rgm_contacts (id, locationId, email, timezone, firstName, lastName, contactName, phone) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET locationId = EXCLUDED.locationId, email = EXCLUDED.email, timezone = EXCLUDED.timezone, firstName = EXCLUDED.firstName, lastName = EXCLUDED.lastName, contactName = EXCLUDED.contactName, phone = EXCLUDED.phone;"
+        # along with the normalized keys they are matched on and their fuzzy matching block
+        query = "INSERT INTO rgm_contacts (id, locationId, email, timezone, firstName, lastName, contactName, phone, phone_key, email_key, first_name_key, last_name_key, name_block) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET locationId = EXCLUDED.locationId, email = EXCLUDED.email, timezone = EXCLUDED.timezone, firstName = EXCLUDED.firstName, lastName = EXCLUDED.lastName, contactName = EXCLUDED.contactName, phone = EXCLUDED.phone, phone_key = EXCLUDED.phone_key, email_key = EXCLUDED.email_key, first_name_key = EXCLUDED.first_name_key, last_name_key = EXCLUDED.last_name_key, name_block = EXCLUDED.name_block;"
         cursor = self.conn.cursor()
         # format contact_data from list of objects to list of tuples
         formatted_contact_data = []
@@ -131,22 +543,63 @@ class SQLiteDB:
                     contact.get("lastName", None),
                     contact.get("contactName", None),
                     contact.get("phone", None),
+                    *contact_match_keys(
+                        contact.get("phone"), contact.get("email"), contact.get("firstName"), contact.get("lastName")
+                    ),
+                    name_block_key(contact.get("lastName")),
                 )
             )
 
         cursor.executemany(query, formatted_contact_data)
         print(f"Added/Updated {cursor.rowcount} records in rgm_contacts table")
-        self.conn.commit()
+        self._commit()
+        return True
+
+    def fetch_sync_watermark(self, location_id):
+        """Returns (last_synced_at, last_date_updated) for the location or None if it was never synced"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT last_synced_at, last_date_updated FROM rgm_sync_state WHERE locationId = ?;", (location_id,)
+        )
+        return cursor.fetchone()
+
+    @serialized_write
+    def update_sync_watermark(self, location_id, last_synced_at, last_date_updated):
+        query = """
+            INSERT INTO rgm_sync_state (locationId, last_synced_at, last_date_updated) VALUES (?, ?, ?)
+            ON CONFLICT (locationId) DO UPDATE SET
+                last_synced_at = EXCLUDED.last_synced_at,
+                last_date_updated = EXCLUDED.last_date_updated;
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(query, (location_id, last_synced_at, last_date_updated))
+        self._commit()
         return True
 
+    def fetch_location_contacts(self, location_id):
+        """returns every rgm_contacts row of the location in table order"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT * FROM rgm_contacts WHERE locationId = ? ORDER BY rowid;", (location_id,))
+        return cursor.fetchall()
+
     def attempt_contact_retrieval(self, phone_number, email, first_name, last_name, location_id):
+        """
+        Returns the first contact of the location matching the phone or the email, then the first matching
+        first and last name. Arguments are the normalized keys, see normalize.contact_match_keys
+        """
+        # one probe per composite index instead of an OR the planner answers with a scan of the location
         query_email_phone = f"""
             SELECT *
             FROM rgm_contacts
-            WHERE (phone = ? OR email = ?) AND locationId = ?;
+            WHERE rowid IN (
+                SELECT rowid FROM rgm_contacts WHERE locationId = ? AND phone_key = ?
+                UNION ALL
+                SELECT rowid FROM rgm_contacts WHERE locationId = ? AND email_key = ?
+            )
+            ORDER BY rowid;
         """
         cursor = self.conn.cursor()
-        cursor.execute(query_email_phone, (phone_number, email, location_id))
+        cursor.execute(query_email_phone, (location_id, phone_number, location_id, email))
 
         # Fetch the results
         results = cursor.fetchall()
@@ -157,7 +610,8 @@ class SQLiteDB:
         query_name = f"""
             SELECT *
             FROM rgm_contacts
-            WHERE (firstName = ? AND lastName = ?) and locationId = ?;
+            WHERE (first_name_key = ? AND last_name_key = ?) and locationId = ?
+            ORDER BY rowid;
         """
         cursor.execute(query_name, (first_name, last_name, location_id))
         results = cursor.fetchall()
@@ -169,6 +623,274 @@ class SQLiteDB:
 
         return None
 
+    def attempt_fuzzy_name_retrieval(self, first_name, last_name, location_id, threshold=None, margin=None):
+        """
+        Returns the contact of the location whose name is the closest fuzzy match (see fuzzy_match.best_name_match),
+        only contacts in the same name block are read. first_name and last_name are normalized name keys.
+        """
+        block = name_block_key(last_name)
+        if first_name is None or block is None:
+            return None
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT * FROM rgm_contacts WHERE locationId = ? AND name_block = ? ORDER BY rowid;", (location_id, block)
+        )
+        # first_name_key and last_name_key are the 11th and 12th columns
+        candidates = ((record[10], record[11], record) for record in cursor.fetchall())
+        options = {key: value for key, value in (("threshold", threshold), ("margin", margin)) if value is not None}
+        return best_name_match(first_name, last_name, candidates, **options)
+
+    @serialized_write
+    def start_job_run(self, run_type, location_ids, resume=True, run_key=None, join_window=0):
+        """
+        Queues a job of run_type for every location and returns the run id.
+        With resume, a run of run_type that still has unfinished jobs, or whose last job finished less than
+        join_window seconds ago, is joined instead: its jobs keep their state and attempts and the locations it
+        doesn't have yet are added to it, so processes started for the same run type share one run even when one
+        starts after another finished. Jobs a crashed process left running are claimed again once their lease expires.
+        Otherwise every location starts over as pending in a new run.
+        run_key: the run id to join or start, processes passing the same key share the run whatever its state
+        """
+        now = time.time()
+        # processes starting at the same time must agree on the run
+        with self._immediate_transaction():
+            cursor = self.conn.cursor()
+            joined = None
+            if run_key is not None:
+                joined = (run_key,)
+            elif resume:
+                cursor.execute(
+                    """
+                    SELECT run_id FROM rgm_jobs WHERE run_type = ? AND state IN ('pending', 'running', 'retry') LIMIT 1;
+                    """,
+                    (run_type,),
+                )
+                joined = cursor.fetchone()
+                if joined is None and join_window > 0:
+                    cursor.execute(
+                        """
+                        SELECT run_id FROM rgm_jobs WHERE run_type = ? AND finished_at >= ?
+                        ORDER BY finished_at DESC LIMIT 1;
+                        """,
+                        (run_type, now - join_window),
+                    )
+                    joined = cursor.fetchone()
+
+            run_id = joined[0] if joined else uuid.uuid4().hex
+            # jobs already in the run are left alone, jobs of earlier runs start over
+            query = """
+                INSERT INTO rgm_jobs (run_type, locationId, run_id, created_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (run_type, locationId) DO UPDATE SET
+                    run_id = EXCLUDED.run_id, state = 'pending', attempts = 0, next_attempt_at = 0,
+                    claimed_by = NULL, created_at = EXCLUDED.created_at, started_at = NULL, finished_at = NULL,
+                    duration = NULL, last_error = NULL, lease_expires_at = NULL
+                WHERE rgm_jobs.run_id != EXCLUDED.run_id;
+            """
+            cursor.executemany(query, [(run_type, location_id, run_id, now) for location_id in location_ids])
+        return run_id
+
+    @serialized_write
+    def claim_job(self, run_type, run_id, worker_id, lease_seconds):
+        """
+        Marks the next due job of the run as running for worker_id, leased for lease_seconds, and returns
+        (locationId, attempts) with the attempt it is on, or None when no job is due.
+        Running jobs whose lease expired are due again, their worker is presumed dead.
+        """
+        now = time.time()
+        cursor = self.conn.cursor()
+        with self._immediate_transaction():
+            while True:
+                cursor.execute(
+                    """
+                    SELECT locationId FROM rgm_jobs
+                    WHERE run_type = ? AND run_id = ? AND (
+                        (state IN ('pending', 'retry') AND next_attempt_at <= ?)
+                        OR (state = 'running' AND lease_expires_at <= ?)
+                    )
+                    ORDER BY next_attempt_at, rowid LIMIT 1;
+                    """,
+                    (run_type, run_id, now, now),
+                )
+                job = cursor.fetchone()
+                if job is None:
+                    return None
+                # only succeeds if no other worker or process claimed the job in between
+                cursor.execute(
+                    """
+                    UPDATE rgm_jobs SET state = 'running', attempts = attempts + 1, claimed_by = ?, started_at = ?,
+                        lease_expires_at = ?
+                    WHERE run_type = ? AND locationId = ? AND (
+                        state IN ('pending', 'retry') OR (state = 'running' AND lease_expires_at <= ?)
+                    );
+                    """,
+                    (worker_id, now, now + lease_seconds, run_type, job[0], now),
+                )
+                if cursor.rowcount == 1:
+                    break
+        return job[0], self.fetch_job(run_type, job[0])[4]
+
+    @serialized_write
+    def renew_job_leases(self, run_type, jobs, lease_seconds):
+        """extends the leases of the running jobs in jobs, a list of (locationId, worker_id)"""
+        lease_expires_at = time.time() + lease_seconds
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            """
+            UPDATE rgm_jobs SET lease_expires_at = ?
+            WHERE run_type = ? AND locationId = ? AND claimed_by = ? AND state = 'running';
+            """,
+            [(lease_expires_at, run_type, location_id, worker_id) for location_id, worker_id in jobs],
+        )
+        self._commit()
+        return True
+
+    @serialized_write
+    def finish_job(self, run_type, location_id, worker_id, state, error=None, next_attempt_at=0):
+        """
+        Records the outcome of a job worker_id is running, state is done, failed or retry (due again at
+        next_attempt_at). Returns False when the job's lease was lost to another worker and nothing was recorded.
+        """
+        now = time.time()
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            UPDATE rgm_jobs SET state = ?, last_error = ?, next_attempt_at = ?, claimed_by = NULL,
+                finished_at = ?, duration = ? - started_at, lease_expires_at = NULL
+            WHERE run_type = ? AND locationId = ? AND claimed_by = ? AND state = 'running';
+            """,
+            (state, error, next_attempt_at, now, now, run_type, location_id, worker_id),
+        )
+        self._commit()
+        return cursor.rowcount == 1
+
+    def fetch_job(self, run_type, location_id):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT * FROM rgm_jobs WHERE run_type = ? AND locationId = ?;", (run_type, location_id))
+        return cursor.fetchone()
+
+    def fetch_run_jobs(self, run_type, run_id):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT * FROM rgm_jobs WHERE run_type = ? AND run_id = ? ORDER BY rowid;", (run_type, run_id))
+        return cursor.fetchall()
+
+    def fetch_run_progress(self, run_type, run_id):
+        """
+        Returns ({state: job count}, the earliest time a job of the run can next be claimed or None when every job
+        is finished). Running jobs count from their lease expiry, in case their worker died.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT state, COUNT(*), MIN(CASE WHEN state = 'running' THEN lease_expires_at ELSE next_attempt_at END)
+            FROM rgm_jobs
+            WHERE run_type = ? AND run_id = ? GROUP BY state;
+            """,
+            (run_type, run_id),
+        )
+        counts = {}
+        waiting = []
+        for state, count, next_claim_at in cursor.fetchall():
+            counts[state] = count
+            if state in ("pending", "retry", "running"):
+                waiting.append(next_claim_at or 0)
+        return counts, min(waiting) if waiting else None
+
+    @serialized_write
+    def acquire_lease(self, name, owner, lease_seconds):
+        """
+        Takes the named lease for owner for lease_seconds, returns False while another owner holds it.
+        An owner re-acquiring its own lease extends it, expired leases are taken over.
+        """
+        now = time.time()
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO rgm_leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+            WHERE rgm_leases.owner = EXCLUDED.owner OR rgm_leases.expires_at <= ?;
+            """,
+            (name, owner, now + lease_seconds, now),
+        )
+        self._commit()
+        return cursor.rowcount == 1
+
+    @serialized_write
+    def release_lease(self, name, owner):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM rgm_leases WHERE name = ? AND owner = ?;", (name, owner))
+        self._commit()
+        return cursor.rowcount == 1
+
+    def fetch_failure(self, kind, target):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT * FROM rgm_failures WHERE kind = ? AND target = ?;", (kind, target))
+        return cursor.fetchone()
+
+    def fetch_open_failures(self, kind):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT target, error_class, failures, open_until FROM rgm_failures
+            WHERE kind = ? AND open_until > ? ORDER BY open_until;
+            """,
+            (kind, time.time()),
+        )
+        return cursor.fetchall()
+
+    @serialized_write
+    def record_failure(self, kind, target, error_class, error, cooldown, max_cooldown, threshold):
+        """
+        Counts a failure of the target. From threshold consecutive failures on the target is skipped for cooldown
+        seconds, doubled for every further failure up to max_cooldown. Returns True when the target is skipped now.
+        """
+        now = time.time()
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO rgm_failures (kind, target, error_class, error, failures, first_failed_at, last_failed_at)
+            VALUES (?, ?, ?, ?, 1, ?, ?)
+            ON CONFLICT (kind, target) DO UPDATE SET
+                error_class = EXCLUDED.error_class,
+                error = EXCLUDED.error,
+                failures = rgm_failures.failures + 1,
+                last_failed_at = EXCLUDED.last_failed_at;
+            """,
+            (kind, target, error_class, error, now, now),
+        )
+        cursor.execute(
+            """
+            UPDATE rgm_failures SET open_until = CASE
+                WHEN failures >= ? THEN ? + MIN(?, ? * (1 << MIN(failures - ?, 30)))
+                ELSE 0 END
+            WHERE kind = ? AND target = ?;
+            """,
+            (threshold, now, max_cooldown, cooldown, threshold, kind, target),
+        )
+        self._commit()
+        return bool(self.fetch_failure(kind, target)[7])
+
+    @serialized_write
+    def claim_failure_probe(self, kind, target, probe_until):
+        """lets one caller probe a target whose cooldown expired, by pushing open_until to probe_until"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            UPDATE rgm_failures SET open_until = ?
+            WHERE kind = ? AND target = ? AND open_until > 0 AND open_until <= ?;
+            """,
+            (probe_until, kind, target, time.time()),
+        )
+        self._commit()
+        return cursor.rowcount == 1
+
+    @serialized_write
+    def clear_failure(self, kind, target):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM rgm_failures WHERE kind = ? AND target = ?;", (kind, target))
+        self._commit()
+        return cursor.rowcount == 1
+
+    @serialized_write
     def retailer_updated(self, location_id, status):
         """
         Status:
@@ -183,5 +905,5 @@ class SQLiteDB:
         """
         cursor = self.conn.cursor()
         cursor.execute(query, (status, location_id))
-        self.conn.commit()
+        self._commit()
         return
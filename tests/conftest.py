@@ -0,0 +1,16 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def workdir(tmp_path_factory):
+    """working directory utils is imported in, it opens database.db and error.log there"""
+    return tmp_path_factory.mktemp("workdir")
+
+
+@pytest.fixture(scope="session")
+def utils_module(workdir):
+    import importlib
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(workdir)
+        yield importlib.import_module("gohighlevel_oauth_demo_flask.utils")
@@ -0,0 +1,16 @@
+from gohighlevel_oauth_demo_flask.analysis import missing_contacts_report
+
+HEADERS = ["Phone", "Email", "First Name", "Last Name", "Contact ID", "Location ID"]
+
+
+def test_report_skips_sheets_missing_headers():
+    sheets = [
+        ("loc1", "link1", [HEADERS, ["555", "", "Ann", "Lee", "", ""], ["556", "", "Bob", "Ray", "c1", "loc1"]]),
+        # no "location id" column, used to abort the whole report with a KeyError
+        ("loc2", "link2", [HEADERS[:-1], ["557", "", "Cat", "Day", ""]]),
+        ("loc3", "link3", [HEADERS, ["", "d@example.com", "Dan", "Fox", "", ""]]),
+    ]
+
+    report = missing_contacts_report(sheets)
+
+    assert report.values.tolist() == [["loc1", "link1", 1, "Ann", "Lee"], ["loc3", "link3", 1, "Dan", "Fox"]]
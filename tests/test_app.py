@@ -0,0 +1,59 @@
+import importlib
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def app_module(utils_module, workdir):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(workdir)
+        module = importlib.import_module("oauth_flask.app")
+        yield module
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def test_metrics_renders_the_registry_the_modules_record_into(app_module, client):
+    from gohighlevel_oauth_demo_flask import metrics, utils
+
+    assert app_module.REGISTRY is metrics.REGISTRY
+    assert app_module.GHL_CLIENT is utils.GHL_CLIENT
+    assert app_module.db is utils.DB
+
+    utils.DB.fetch_all_records("api_data")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'rgm_sqlite_calls_total{method="fetch_all_records"}' in body
+    assert 'rgm_breaker_skipped_total{kind="lds"}' in body
+    assert 'rgm_rate_limiter_throttled_total{api="ghl_v2"}' in body
+
+
+@pytest.mark.parametrize(
+    "body",
+    ['{"locationIds": "abc"}', '["abc"]', '{"locationIds": [1, 2]}', '{"locationIds": [""]}', "not json"],
+)
+def test_refresh_rejects_malformed_bodies(app_module, client, monkeypatch, body):
+    monkeypatch.setattr(app_module, "refresh_locations", lambda location_ids: pytest.fail("should not refresh"))
+
+    response = client.post("/refresh", data=body, content_type="application/json")
+
+    assert response.status_code == 400
+    assert response.get_json()["status"] == "error"
+
+
+def test_refresh_merges_query_and_body_location_ids(app_module, client, monkeypatch):
+    monkeypatch.setattr(
+        app_module,
+        "refresh_locations",
+        lambda location_ids: {location_id: {"status": "ok"} for location_id in location_ids},
+    )
+
+    response = client.post("/refresh?locationId=a", json={"locationIds": ["a", "b"]})
+
+    assert response.status_code == 200
+    assert response.get_json() == {"a": {"status": "ok"}, "b": {"status": "ok"}}
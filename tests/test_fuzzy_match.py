@@ -0,0 +1,75 @@
+import pytest
+
+from gohighlevel_oauth_demo_flask.fuzzy_match import best_name_match, jaro_winkler
+from gohighlevel_oauth_demo_flask.normalize import soundex
+
+
+@pytest.mark.parametrize(
+    "a, b, similarity",
+    [
+        ("martha", "marhta", 0.961),
+        ("dwayne", "duane", 0.84),
+        ("dixon", "dicksonx", 0.813),
+        ("mark", "mary", 0.883),
+        ("smith", "smith", 1.0),
+        ("abc", "xyz", 0.0),
+        ("", "smith", 0.0),
+    ],
+)
+def test_jaro_winkler(a, b, similarity):
+    assert jaro_winkler(a, b) == pytest.approx(similarity, abs=0.001)
+    assert jaro_winkler(b, a) == pytest.approx(similarity, abs=0.001)
+
+
+@pytest.mark.parametrize(
+    "name, code",
+    [
+        ("Robert", "R163"),
+        ("Rupert", "R163"),
+        ("smith", "S530"),
+        ("smyth", "S530"),
+        ("Ashcraft", "A261"),
+        ("Pfister", "P236"),
+        ("Tymczak", "T522"),
+        ("Lee", "L000"),
+        ("O'Brien", "O165"),
+        ("123", None),
+        (None, None),
+    ],
+)
+def test_soundex(name, code):
+    assert soundex(name) == code
+
+
+def test_best_name_match_accepts_a_last_name_typo():
+    candidates = [("john", "johnson", "c1"), ("john", "jackson", "c2")]
+    assert best_name_match("john", "johnsen", candidates) == "c1"
+
+
+@pytest.mark.parametrize(
+    "first_name, last_name, candidate",
+    [
+        # close first names are different people
+        ("mark", "smith", ("mary", "smith", "c1")),
+        ("eric", "jones", ("erica", "jones", "c1")),
+        ("chris", "smith", ("christopher", "smith", "c1")),
+        # different last names that happen to look alike
+        ("ann", "jones", ("ann", "jonas", "c1")),
+        ("ann", "martin", ("ann", "martinez", "c1")),
+        ("ann", "lewis", ("ann", "lewin", "c1")),
+    ],
+)
+def test_best_name_match_rejects_different_people(first_name, last_name, candidate):
+    assert best_name_match(first_name, last_name, [candidate]) is None
+
+
+def test_best_name_match_leaves_ambiguous_rows_unmatched():
+    # both are one letter off, neither beats the other by the margin
+    candidates = [("john", "smithe", "c1"), ("john", "smithy", "c2")]
+    assert best_name_match("john", "smith", candidates) is None
+    assert best_name_match("john", "smith", candidates, margin=0) == "c1"
+
+
+def test_best_name_match_skips_incomplete_names():
+    assert best_name_match(None, "smith", [("john", "smith", "c1")]) is None
+    assert best_name_match("john", "smith", [(None, "smith", "c1"), ("john", "smith", "c2")]) == "c2"
@@ -0,0 +1,167 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from gohighlevel_oauth_demo_flask.jobs import JobEngine, PermanentJobError
+from gohighlevel_oauth_demo_flask.sqlite_db import SQLiteDB
+
+WORKER = textwrap.dedent(
+    """
+    import json, sys, time
+    from gohighlevel_oauth_demo_flask.sqlite_db import SQLiteDB
+    from gohighlevel_oauth_demo_flask.jobs import JobEngine
+
+    db_path, log_path, job_count, run_key = sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4]
+    db = SQLiteDB(db_path)
+
+    def handler(location_id):
+        with open(log_path, "a") as log:
+            log.write(location_id + "\\n")
+        time.sleep(0.001)
+
+    engine = JobEngine(db, "two_process", handler, max_workers=8, retry_delay=0.1, lease_seconds=30)
+    db.start_writer()
+    try:
+        summary = engine.run([f"L{number:04d}" for number in range(job_count)], run_key=run_key)
+    finally:
+        db.stop_writer()
+    sys.stdout.write("SUMMARY " + json.dumps({location_id: job["state"] for location_id, job in summary.items()}))
+    """
+)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # a fresh shared instance for the test, the one other tests or utils opened is restored afterwards
+    monkeypatch.setattr(SQLiteDB, "_instance", None)
+    return SQLiteDB(str(tmp_path / "jobs.db"))
+
+
+def test_two_processes_share_one_run(db, tmp_path):
+    job_count = 400
+    location_ids = [f"L{number:04d}" for number in range(job_count)]
+    # the run exists before either process starts, however their start-up interleaves they join it
+    db.start_job_run("two_process", location_ids, run_key="two-process-run")
+
+    logs = [str(tmp_path / f"worker{number}.log") for number in range(2)]
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-c", WORKER, db.db_name, log, str(job_count), "two-process-run"],
+            cwd=tmp_path,
+            env=os.environ.copy(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        for log in logs
+    ]
+    outputs = [worker.communicate(timeout=300) for worker in workers]
+
+    for worker, (stdout, stderr) in zip(workers, outputs):
+        assert worker.returncode == 0, stderr
+        assert "database is locked" not in stderr
+
+    handled = []
+    for log in logs:
+        # a process that lost every claim to the other one never writes its log
+        if os.path.exists(log):
+            with open(log) as file:
+                handled.extend(file.read().split())
+    # every job ran exactly once across both processes
+    assert sorted(handled) == location_ids
+
+    # both processes worked the same run and see every job done
+    for stdout, _ in outputs:
+        summary = json.loads(stdout.rsplit("SUMMARY ", 1)[1])
+        assert len(summary) == job_count
+        assert set(summary.values()) == {"done"}
+    assert {job[2] for job in db.fetch_run_jobs("two_process", "two-process-run")} == {"two-process-run"}
+
+
+def counting_engine(db, handled, **options):
+    return JobEngine(db, "late", lambda location_id: handled.append(location_id), retry_delay=0.01, **options)
+
+
+def test_late_process_joins_a_recently_finished_run(db):
+    handled = []
+    first = counting_engine(db, handled).run(["L1", "L2"])
+    # started after the first process finished the whole run
+    second = counting_engine(db, handled).run(["L1", "L2"])
+
+    assert sorted(handled) == ["L1", "L2"]
+    assert second == first
+
+
+def test_run_after_the_join_window_starts_over(db):
+    handled = []
+    counting_engine(db, handled, join_window=0).run(["L1"])
+    counting_engine(db, handled, join_window=0).run(["L1"])
+    assert handled == ["L1", "L1"]
+
+
+def test_processes_with_the_same_run_key_share_the_run(db):
+    handled = []
+    counting_engine(db, handled, join_window=0).run(["L1", "L2"], run_key="2026-10-17")
+    counting_engine(db, handled, join_window=0).run(["L1", "L2", "L3"], run_key="2026-10-17")
+    # another key is another run
+    counting_engine(db, handled, join_window=0).run(["L1"], run_key="2026-10-18")
+
+    assert sorted(handled[:2]) == ["L1", "L2"]
+    assert handled[2:] == ["L3", "L1"]
+
+
+def test_on_failure_is_called_only_when_a_job_is_given_up_on(db):
+    attempts = {}
+    failures = []
+
+    def handler(location_id):
+        attempts[location_id] = attempts.get(location_id, 0) + 1
+        if location_id == "flaky" and attempts[location_id] == 1:
+            raise RuntimeError("first attempt fails")
+        if location_id == "broken":
+            raise RuntimeError("every attempt fails")
+        if location_id == "permanent":
+            raise PermanentJobError("no point retrying")
+
+    engine = JobEngine(
+        db,
+        "on_failure",
+        handler,
+        max_workers=2,
+        max_attempts=3,
+        retry_delay=0.01,
+        on_failure=lambda location_id, error: failures.append((location_id, type(error).__name__)),
+    )
+    summary = engine.run(["flaky", "broken", "permanent", "fine"])
+
+    assert {location_id: job["state"] for location_id, job in summary.items()} == {
+        "flaky": "done",
+        "broken": "failed",
+        "permanent": "failed",
+        "fine": "done",
+    }
+    assert attempts == {"flaky": 2, "broken": 3, "permanent": 1, "fine": 1}
+    assert sorted(failures) == [("broken", "RuntimeError"), ("permanent", "PermanentJobError")]
+
+
+def test_on_failure_is_called_when_every_lease_expired(db):
+    failures = []
+    engine = JobEngine(
+        db,
+        "lease_expired",
+        lambda location_id: None,
+        max_attempts=2,
+        on_failure=lambda location_id, error: failures.append(location_id),
+    )
+    run_id = db.start_job_run("lease_expired", ["L1"])
+    location_id, _ = db.claim_job("lease_expired", run_id, "worker", 30)
+
+    # the claim after the last allowed attempt's worker died
+    engine._execute(location_id, 3, "worker")
+
+    assert failures == ["L1"]
+    assert engine.summary(run_id)["L1"]["state"] == "failed"
@@ -0,0 +1,46 @@
+from gohighlevel_oauth_demo_flask.sheets import SheetSession
+
+
+class Spreadsheet:
+    def __init__(self, url):
+        self.url = url
+
+    def get_worksheet(self, index):
+        return object()
+
+
+class Client:
+    def __init__(self):
+        self.opened = []
+
+    def open_by_url(self, url):
+        self.opened.append(url)
+        return Spreadsheet(url)
+
+
+def test_session_keeps_at_most_max_sheets():
+    client = Client()
+    session = SheetSession(client, max_sheets=2)
+
+    first = session.open("a")
+    session.open("b")
+    assert session.open("a") is first
+    # "b" is the least recently used sheet
+    session.open("c")
+
+    assert [url for url, _ in session.worksheets] == ["a", "c"]
+    session.open("b")
+    assert client.opened == ["a", "b", "c", "b"]
+
+
+def test_release_drops_the_sheet():
+    client = Client()
+    session = SheetSession(client)
+
+    first = session.open("a")
+    session.open("a", index=1)
+    session.open("b")
+    session.release("a")
+
+    assert list(session.worksheets) == [("b", 0)]
+    assert session.open("a") is not first
@@ -0,0 +1,46 @@
+import pytest
+
+from gohighlevel_oauth_demo_flask.sqlite_db import SQLiteDB
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # a fresh shared instance for the test, the one other tests or utils opened is restored afterwards
+    monkeypatch.setattr(SQLiteDB, "_instance", None)
+    return SQLiteDB(str(tmp_path / "a.db"))
+
+
+def test_shared_instance_refuses_another_database(db, tmp_path, monkeypatch):
+    assert SQLiteDB(str(tmp_path / "a.db")) is db
+    monkeypatch.chdir(tmp_path)
+    assert SQLiteDB("a.db") is db
+
+    with pytest.raises(ValueError):
+        SQLiteDB()
+    assert db.db_name == str(tmp_path / "a.db")
+
+
+def test_nested_writer_batches_share_one_writer(db):
+    outer = db.start_writer()
+    inner = db.start_writer()
+    assert inner is outer
+
+    db.stop_writer()
+    # the outer batch still queues its writes onto the running writer
+    assert db.writer is outer and outer.thread.is_alive()
+    token = {
+        "userType": "Location",
+        "companyId": "C1",
+        "locationId": "L1",
+        "access_token": "a",
+        "token_type": "Bearer",
+        "expires_in": 3600,
+        "refresh_token": "r",
+        "scope": "",
+    }
+    db.insert_or_update_token(token)
+
+    assert db.stop_writer()
+    assert db.writer is None and not outer.thread.is_alive()
+    assert not db.stop_writer()
+    assert db.get_access_token("L1") == "a"
@@ -0,0 +1,74 @@
+import pytest
+
+
+@pytest.fixture
+def retailer(utils_module):
+    utils_module.DB.create_retailers_table()
+    utils_module.DB.insert_many_retailer_records([("loc-opps", "https://docs.google.com/spreadsheets/d/opps")])
+    utils_module.DB.retailer_updated("loc-opps", 0)
+    return "loc-opps", "https://docs.google.com/spreadsheets/d/opps"
+
+
+def retailer_status(utils_module, location_id):
+    return utils_module.DB.fetch_single_column("rgm_retailers", "lds_updated", "locationId", location_id)[0]
+
+
+def test_failed_opportunities_attempt_leaves_the_retailer_for_retry(utils_module, retailer, monkeypatch):
+    location_id, lds_link = retailer
+    monkeypatch.setattr(utils_module, "open_lds", lambda *args, **kwargs: (False, None))
+
+    with pytest.raises(utils_module.LeadDataSheetError):
+        utils_module.update_lds_with_opportunities(None, location_id, "key", lds_link)
+
+    assert retailer_status(utils_module, location_id) == 0
+
+
+def test_given_up_opportunities_job_flags_the_retailer(utils_module, retailer, monkeypatch):
+    location_id, lds_link = retailer
+    tasks = []
+    monkeypatch.setattr(utils_module, "create_clickup_task", lambda *args: tasks.append(args))
+
+    utils_module.lds_opportunities_failed(location_id, lds_link)
+
+    assert retailer_status(utils_module, location_id) == 2
+    assert tasks == [(location_id, lds_link)]
+
+
+def api_error(code, status):
+    import requests
+    from gspread.exceptions import APIError
+
+    response = requests.Response()
+    response.status_code = code
+    response._content = ('{"error": {"code": %d, "message": "%s", "status": "%s"}}' % (code, status, status)).encode()
+    return APIError(response)
+
+
+class FailingClient:
+    def __init__(self, error):
+        self.error = error
+
+    def open_by_url(self, url):
+        raise self.error
+
+
+@pytest.mark.parametrize(
+    "code, status", [(429, "RESOURCE_EXHAUSTED"), (500, "INTERNAL"), (502, "BAD_GATEWAY"), (503, "UNAVAILABLE")]
+)
+def test_transient_sheets_errors_dont_open_the_breaker(utils_module, code, status, monkeypatch):
+    # the 429s the limiter gave up retrying
+    monkeypatch.setattr(utils_module.SHEETS_LIMITER, "max_retries", 0)
+    lds_link = f"https://docs.google.com/spreadsheets/d/transient-{code}"
+    for _ in range(5):
+        assert utils_module.open_lds(FailingClient(api_error(code, status)), lds_link, "loc") == (False, None)
+
+    assert not utils_module.LDS_BREAKER.is_open(lds_link)
+    assert utils_module.DB.fetch_failure("lds", lds_link) is None
+
+
+@pytest.mark.parametrize("code, status", [(403, "PERMISSION_DENIED"), (404, "NOT_FOUND")])
+def test_sheet_specific_errors_open_the_breaker(utils_module, code, status):
+    lds_link = f"https://docs.google.com/spreadsheets/d/broken-{code}"
+    assert utils_module.open_lds(FailingClient(api_error(code, status)), lds_link, "loc") == (False, None)
+
+    assert utils_module.LDS_BREAKER.is_open(lds_link)
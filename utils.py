@@ -1,12 +1,23 @@
-import requests
 import logging
 from gohighlevel_oauth_demo_flask.config import CLIENT_ID, CLIENT_SECRET
 from gohighlevel_oauth_demo_flask.sqlite_db import SQLiteDB
-from requests.exceptions import JSONDecodeError
-from gspread.exceptions import APIError
-from time import sleep
+from requests.exceptions import JSONDecodeError, RequestException
+from gspread.exceptions import APIError, NoValidUrlKeyFound, SpreadsheetNotFound
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 import gspread
-from gohighlevel_oauth_demo_flask.keys import GoHighLevelConfig, GoogConfig, ClickUpConfig
+from gohighlevel_oauth_demo_flask.keys import GoHighLevelConfig, GoogConfig, ClickUpConfig, JobConfig, MatchConfig
+from gohighlevel_oauth_demo_flask.ghl_client import GHL_CLIENT, API_VERSION, REST_V1_URL, SERVICES_URL, TOKEN_URL
+from gohighlevel_oauth_demo_flask.rate_limit import RATE_LIMITERS
+from gohighlevel_oauth_demo_flask.contact_index import ContactIndex
+from gohighlevel_oauth_demo_flask.normalize import contact_match_keys
+from gohighlevel_oauth_demo_flask.sheets import SHEETS_LIMITER, sheet_session
+from gohighlevel_oauth_demo_flask.analysis import analyze_missing_contacts, missing_contacts_report
+from gohighlevel_oauth_demo_flask.jobs import JobEngine, PermanentJobError
+from gohighlevel_oauth_demo_flask.leases import Lease, in_shard, sharded_run_type
+from gohighlevel_oauth_demo_flask.circuit_breaker import CircuitBreaker, CircuitOpenError, classify_status
+from gohighlevel_oauth_demo_flask.single_flight import SingleFlight
+from gohighlevel_oauth_demo_flask.metrics import REGISTRY, ROWS_PROCESSED, log_summary, snapshot
 
 import sys, os
 
@@ -23,14 +34,40 @@ from clickup_python_sdk.clickupobjects.list import List
 logging.basicConfig(filename="error.log", level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 CLICKUP_CLIENT = ClickupClient.init(ClickUpConfig.ACCESS_TOKEN)
+CLICKUP_LIMITER = RATE_LIMITERS["clickup"]
+
+# the only lead data sheet columns the contact matching routines read
+LDS_HEADERS = ["phone", "email", "first name", "last name", "contact id", "location id"]
 
 
 class RefreshTokenError(Exception):
     pass
 
 
+class LeadDataSheetError(Exception):
+    pass
+
+
 DB = SQLiteDB()
 
+# known-bad lead data sheets (keyed by URL) and locations whose token can't be refreshed are skipped until they cool down
+LDS_BREAKER = CircuitBreaker(DB, "lds")
+TOKEN_BREAKER = CircuitBreaker(DB, "token")
+
+
+def breaker_stats():
+    """returns the skip, probe, failure and recovery counts of every circuit breaker"""
+    return {"lds": LDS_BREAKER.stats(), "token": TOKEN_BREAKER.stats()}
+
+
+@REGISTRY.add_collector
+def _breaker_metrics():
+    for kind, stats in breaker_stats().items():
+        for counter, count in stats.items():
+            yield f"rgm_breaker_{counter}_total", "counter", f"Circuit breaker {counter} count", {"kind": kind}, count
+    for counter, count in TOKEN_REFRESHES.stats().items():
+        yield f"rgm_token_refresh_{counter}_total", "counter", f"Single-flight token refresh {counter}", {}, count
+
 
 def verify_response(response):
     if "error" in response:
@@ -41,18 +78,85 @@ def verify_response(response):
     return True
 
 
-def refresh_tokens():
-    """refreshes all of the tokens in the api_data table"""
+REFRESH_MAX_WORKERS = GoHighLevelConfig.REFRESH_WORKERS
+
+# GHL refresh tokens are single use, concurrent refreshes of a location share one token exchange
+TOKEN_REFRESHES = SingleFlight(ttl=GoHighLevelConfig.REFRESH_COALESCE_SECONDS)
+
+
+def refresh_tokens(max_workers=REFRESH_MAX_WORKERS):
+    """
+    Refreshes all of the tokens in the api_data table on a bounded thread pool, see refresh_locations
+    """
+    metrics_before = snapshot()
     data = DB.fetch_all_records("api_data")
+    results = refresh_locations([row[2] for row in data], max_workers)
+    log_summary("token refresh", metrics_before)
+    return results
 
-    for row in data:
-        try:
-            refresh_token = row[6]
-            refresh_one_token(refresh_token)
-        # account for an empty response being sent back or an invalid refresh token
-        except (JSONDecodeError, RefreshTokenError) as e:
-            print(f"Error:\n  Location ID: {row[2]}\n Error: {e}")
-    return True
+
+def refresh_locations(location_ids, max_workers=REFRESH_MAX_WORKERS):
+    """
+    Refreshes the tokens of the given locations on a bounded thread pool.
+    Failures are isolated per location and reported in the returned summary:
+    {locationId: {"status": "ok" | "error" | "skipped", "error": str | None, "expires_at": int | None}}
+    """
+    results = {}
+    if not location_ids:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(location_ids)))) as executor:
+        futures = {executor.submit(refresh_location, location_id): location_id for location_id in location_ids}
+        for future in as_completed(futures):
+            location_id = futures[future]
+            try:
+                expires_at = future.result()
+                results[location_id] = {"status": "ok", "error": None, "expires_at": expires_at}
+            except CircuitOpenError as e:
+                results[location_id] = {"status": "skipped", "error": str(e), "expires_at": None}
+            # account for an empty response being sent back, an invalid refresh token, a network failure or no token
+            except (JSONDecodeError, RefreshTokenError, RequestException, LookupError) as e:
+                logging.error(f"Error refreshing token for Location ID: {location_id} Error: {e}")
+                results[location_id] = {"status": "error", "error": str(e), "expires_at": None}
+    return results
+
+
+def refresh_location(location_id):
+    """
+    Refreshes the location's stored token and returns its new expires_at. Concurrent calls for the same location,
+    and calls up to REFRESH_COALESCE_SECONDS after it, share a single exchange with GHL and get its result.
+    Raises LookupError when no token is stored for the location.
+    """
+    return TOKEN_REFRESHES.do(location_id, _refresh_stored_token, location_id)
+
+
+def _refresh_stored_token(location_id):
+    # read inside the flight, so the exchange always uses the newest refresh token and never a spent one
+    record = DB.fetch_single_column("api_data", "refresh_token", "locationId", location_id)
+    if not record:
+        raise LookupError(f"No token stored for location {location_id}")
+    refresh_location_token(location_id, record[0])
+    return DB.fetch_single_column("api_data", "expires_at", "locationId", location_id)[0]
+
+
+def refresh_location_token(location_id, refresh_token):
+    """
+    refresh_one_token behind the token circuit breaker, raises CircuitOpenError without calling GHL
+    while the location's refresh token is known to be failing
+    """
+    if not TOKEN_BREAKER.allow(location_id):
+        raise CircuitOpenError(f"Token refresh for Location ID: {location_id} is skipped until its cooldown expires")
+    try:
+        refreshed = refresh_one_token(refresh_token)
+    except RefreshTokenError as e:
+        TOKEN_BREAKER.record_failure(location_id, "invalid_token", str(e))
+        raise
+    except (JSONDecodeError, RequestException) as e:
+        error_class = classify_status(getattr(getattr(e, "response", None), "status_code", None))
+        if error_class:
+            TOKEN_BREAKER.record_failure(location_id, error_class, str(e))
+        raise
+    TOKEN_BREAKER.record_success(location_id)
+    return refreshed
 
 
 def refresh_one_token(refresh_token):
@@ -67,9 +171,9 @@ def refresh_one_token(refresh_token):
         "redirect_uri": "http://localhost:3000/oauth/callback",
     }
 
-    headers = {"Accept": "application/json", "Content-Type": "application/x-www-form-urlencoded"}
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
-    response = requests.post("https://services.leadconnectorhq.com/oauth/token", data=data, headers=headers)
+    response = GHL_CLIENT.post(TOKEN_URL, data=data, headers=headers)
 
     if verify_response(response.json()):
         DB.insert_or_update_token(response.json())
@@ -100,8 +204,98 @@ def insert_sheets_retailer_data(mds_data):
     return True
 
 
-def insert_all_contacts_into_db(location_id, api_key, limit=20):
+# number of contacts buffered before they are written to rgm_contacts in one transaction
+CONTACT_FLUSH_SIZE = 500
+
+
+class ContactFetchError(Exception):
+    pass
+
+
+def iter_contact_pages(location_id, api_key, limit=20):
+    """yields every page of contacts for the location from GET /contacts/"""
+    endpoint = "/contacts/"
+    next_page_url = f"{SERVICES_URL}{endpoint}?locationId={location_id}&limit={limit}"
+
+    while next_page_url:
+        response = GHL_CLIENT.get(next_page_url, access_token=api_key, version=API_VERSION)
+        if response.status_code != 200:
+            raise ContactFetchError(response.text)
+
+        data = response.json()
+        yield data.get("contacts", [])
+
+        meta = data.get("meta", {})
+        next_page_url = meta.get("nextPageUrl")
+
+
+def iter_contact_pages_updated_since(location_id, api_key, since, limit=100):
+    """yields pages of contacts whose dateUpdated is at or after since, oldest first, from POST /contacts/search"""
+    url = f"{SERVICES_URL}/contacts/search"
+    body = {
+        "locationId": location_id,
+        "pageLimit": limit,
+        "filters": [{"field": "dateUpdated", "operator": "range", "value": {"gte": since}}],
+        "sort": [{"field": "dateUpdated", "direction": "asc"}],
+    }
+
+    while True:
+        response = GHL_CLIENT.post(url, access_token=api_key, version=API_VERSION, json=body)
+        if response.status_code != 200:
+            raise ContactFetchError(response.text)
+
+        contacts = response.json().get("contacts", [])
+        yield contacts
+
+        search_after = contacts[-1].get("searchAfter") if contacts else None
+        if len(contacts) < limit or not search_after:
+            return
+        body["searchAfter"] = search_after
+
+
+def write_contact_pages(location_id, pages, flush_size=CONTACT_FLUSH_SIZE):
+    """
+    Streams pages of contacts into rgm_contacts. Contacts are written every flush_size
+    contacts (or every page when flush_size is 0) so memory stays flat and pages fetched
+    before a failure are kept.
+
+    Returns {"pages": int, "fetched": int, "written": int, "complete": bool, "last_date_updated": str | None}
+    """
+    counts = {"pages": 0, "fetched": 0, "written": 0, "complete": False, "last_date_updated": None}
+    pending = []
+
+    try:
+        for contacts in pages:
+            pending.extend(contacts)
+            counts["pages"] += 1
+            counts["fetched"] += len(contacts)
+            for contact in contacts:
+                date_updated = contact.get("dateUpdated")
+                if date_updated and (counts["last_date_updated"] is None or date_updated > counts["last_date_updated"]):
+                    counts["last_date_updated"] = date_updated
+
+            if len(pending) >= flush_size:
+                DB.insert_many_contacts(pending)
+                counts["written"] += len(pending)
+                pending = []
+    except ContactFetchError as e:
+        print(f"Error: {e}")
+    else:
+        counts["complete"] = True
+
+    if pending:
+        DB.insert_many_contacts(pending)
+        counts["written"] += len(pending)
+
+    print(f"Inserted {counts['written']} contacts into the database for location {location_id}")
+    ROWS_PROCESSED.inc(counts["written"], kind="contacts", location=location_id)
+    return counts
+
+
+def insert_all_contacts_into_db(location_id, api_key, limit=20, flush_size=CONTACT_FLUSH_SIZE):
     """
+    Streams every contact of a location into rgm_contacts, see write_contact_pages for the returned counts
+
     from oauth_flask.utils import insert_all_contacts_into_db
     from oauth_flask.sqlite_db import SQLiteDB
 
@@ -109,94 +303,170 @@ def insert_all_contacts_into_db(location_id, api_key, limit=20):
 
     "Restore Hyper Wellness (Greenville)"
     location_id = "mnpHSVqel2ytv5VHQl7c"
-    access_token = DB.fetch_single_record("api_data", "locationId", location_id)[3]
+    access_token = DB.get_access_token(location_id)
 
-    contacts = insert_all_contacts_into_db(location_id, access_token)
+    counts = insert_all_contacts_into_db(location_id, access_token)
     """
+    return write_contact_pages(location_id, iter_contact_pages(location_id, api_key, limit), flush_size)
 
-    base_url = "https://services.leadconnectorhq.com"
-    endpoint = "/contacts/"
-    headers = {"Authorization": f"Bearer {api_key}", "Version": "2021-07-28"}
 
-    all_contacts = []
-    next_page_url = f"{base_url}{endpoint}?locationId={location_id}&limit={limit}"
+def sync_location_contacts(location_id, api_key, full_resync=False, limit=100, flush_size=CONTACT_FLUSH_SIZE):
+    """
+    Fetches only the contacts changed since the location's stored watermark, or every contact when
+    the location was never synced or full_resync is set. The watermark only advances after a complete run.
+    """
+    started_at = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+    watermark = DB.fetch_sync_watermark(location_id)
 
-    while next_page_url:
-        response = requests.get(next_page_url, headers=headers)
+    if full_resync or not watermark or not watermark[1]:
+        counts = insert_all_contacts_into_db(location_id, api_key, limit=limit, flush_size=flush_size)
+        last_date_updated = counts["last_date_updated"] or started_at
+    else:
+        pages = iter_contact_pages_updated_since(location_id, api_key, watermark[1], limit=limit)
+        counts = write_contact_pages(location_id, pages, flush_size)
+        last_date_updated = counts["last_date_updated"] or watermark[1]
 
-        if response.status_code == 200:
-            data = response.json()
-            contacts = data.get("contacts", [])
-            all_contacts.extend(contacts)
+    if counts["complete"]:
+        DB.update_sync_watermark(location_id, started_at, last_date_updated)
+    return counts
 
-            meta = data.get("meta", {})
-            next_page_url = meta.get("nextPageUrl")
-        else:
-            print(f"Error: {response.text}")
-            break
 
-    DB.insert_many_contacts(
-        all_contacts,
-    )
-    print(f"Inserted {len(all_contacts)} contacts into the database for location {location_id}")
-    return all_contacts
+def update_contacts_for_retailers(
+    full_resync=False,
+    max_workers=GoHighLevelConfig.SYNC_WORKERS,
+    shard_index=JobConfig.SHARD_INDEX,
+    shard_count=JobConfig.SHARD_COUNT,
+):
+    """
+    Syncs the contacts of every retailer in rgm_retailers. With max_workers > 1 locations are synced
+    concurrently, GHL calls stay under the per-token and global rate limits of GHL_CLIENT and all
+    SQLite writes are funnelled through the single writer thread.
+    Only the retailers of this process's shard (see leases.in_shard) are synced, each under a lease so
+    processes sharing the database never sync the same location at once.
 
+    Returns {locationId: counts | {"error": str}} for every retailer with a stored token
+    """
+    metrics_before = snapshot()
+    retailers = [row for row in DB.fetch_all_records("rgm_retailers") if in_shard(row[0], shard_index, shard_count)]
+    results = {}
 
-def update_contacts_for_retailers():
-    # iterate through each row of the rgm_retailers table
-    retailers = DB.fetch_all_records("rgm_retailers")
-    for row in retailers:
-        # 1. Get the locationId and lead data sheet link from the rgm_retailer table and api key from the api_data table
-        location_id = row[0]
+    def sync_retailer(location_id):
+        # 1. Get the api key for the locationId from the api_data table
         print(f"Querying for {location_id}")
-        api_query = DB.fetch_single_record("api_data", "locationId", location_id)
-        if not api_query:
-            continue
-        api_key = api_query[3]
-
-        # 2. Pass in locationId and api key to the insert_all_contacts_into_db function
-        insert_all_contacts_into_db(location_id, api_key, limit=100)
-    return True
+        api_key = DB.get_access_token(location_id)
+        # tokens that can't be refreshed are revoked, syncing with them only fails
+        if not api_key or not TOKEN_BREAKER.allow(location_id, probe=False):
+            return None
+
+        # another process is already syncing the location
+        lease = Lease(DB, f"contacts:{location_id}")
+        if not lease.acquire():
+            return None
+
+        # 2. Pull the contacts changed since the last successful sync into rgm_contacts
+        with lease:
+            return sync_location_contacts(location_id, api_key, full_resync=full_resync, limit=100)
+
+    if max_workers <= 1:
+        for row in retailers:
+            counts = sync_retailer(row[0])
+            if counts is not None:
+                results[row[0]] = counts
+        log_summary("contacts sync", metrics_before)
+        return results
+
+    DB.start_writer()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(sync_retailer, row[0]): row[0] for row in retailers}
+            for future in as_completed(futures):
+                location_id = futures[future]
+                try:
+                    counts = future.result()
+                except Exception as e:
+                    logging.error(f"Error syncing contacts for Location ID: {location_id} Error: {e}")
+                    results[location_id] = {"error": str(e)}
+                    continue
+                if counts is not None:
+                    results[location_id] = counts
+    finally:
+        DB.stop_writer()
+    log_summary("contacts sync", metrics_before)
+    return results
+
+
+def update_retailers_lead_data_sheets(
+    google_client,
+    max_workers=JobConfig.WORKERS,
+    resume=True,
+    shard_index=JobConfig.SHARD_INDEX,
+    shard_count=JobConfig.SHARD_COUNT,
+    run_key=JobConfig.RUN_KEY,
+):
+    """
+    Writes the contact and location IDs into the lead data sheet of every retailer not updated yet.
+    Each retailer is a "lds_contacts" job in rgm_jobs, worked on max_workers threads, so a failing sheet is
+    retried with backoff without holding up the others and an interrupted run resumes where it stopped.
+    Only the retailers of this process's shard are queued, processes of the same shard share its run.
+    Pass the same run_key (JOB_RUN_KEY) to every process of a scheduled run so late starters join it.
 
+    Returns the job summary, see JobEngine.run
+    """
+    # open and read every lead data sheet at most once for the run
+    google_client = sheet_session(google_client)
 
-def update_retailers_lead_data_sheets(google_client):
-    # iterate through each row of the rgm_retailers table
     retailers = DB.fetch_all_records("rgm_retailers")
-    for row in retailers:
-        # 1. get the lds_link from the rgm_retailers table
-        location_id = row[0]
-        lds_link = row[1]
-        updated = False if row[2] == 0 else True
-
-        # if already updated, skip
-        if updated:
-            continue
+    lds_links = {row[0]: row[1] for row in retailers}
+    # retailers already updated are skipped
+    location_ids = [row[0] for row in retailers if row[2] == 0 and in_shard(row[0], shard_index, shard_count)]
+
+    engine = JobEngine(
+        DB,
+        sharded_run_type("lds_contacts", shard_index, shard_count),
+        lambda location_id: update_retailer_lead_data_sheet(google_client, location_id, lds_links[location_id]),
+        max_workers=max_workers,
+    )
+    DB.start_writer()
+    try:
+        return engine.run(location_ids, resume=resume, run_key=run_key)
+    finally:
+        DB.stop_writer()
 
-        # 2. open the lead data sheet
-        lead_data_sheet = open_lds(google_client, lds_link, location_id)
 
-        if not lead_data_sheet:
-            continue
+def update_retailer_lead_data_sheet(google_client, location_id, lds_link):
+    """
+    Matches the rows of one retailer's lead data sheet to contacts and writes their contact and location IDs.
+    Raises LeadDataSheetError when the sheet can't be opened or written, PermanentJobError when headers are missing.
+    """
+    # 1. open the lead data sheet
+    lead_data_sheet, worksheet_values = open_lds(google_client, lds_link, location_id, headers=LDS_HEADERS)
 
-        worksheet_values = lead_data_sheet.get_all_values()
+    if not lead_data_sheet:
+        # retrying a sheet whose circuit breaker is open would only be skipped again
+        if LDS_BREAKER.is_open(lds_link):
+            raise PermanentJobError(f"Lead data sheet {lds_link} is skipped until its cooldown expires")
+        raise LeadDataSheetError(f"Could not open lead data sheet {lds_link}")
 
-        # map the headers
-        headers_mapping = {header.lower().rstrip(): index for index, header in enumerate(worksheet_values[0])}
+    # map the headers
+    headers_mapping = {header.lower().rstrip(): index for index, header in enumerate(worksheet_values[0])}
 
-        # ensure the proper headers are present
-        missing_headers = verify_headers(
-            ["phone", "email", "first name", "last name", "contact id", "location id"], worksheet_values
-        )
-        if missing_headers:
-            # print and write out the list of missing headers from the missing_headers list of strings
-            print(f"Missing headers in location {location_id}, sheet {lds_link}, headers: {missing_headers}")
-            DB.retailer_updated(location_id, 2)
-            continue
+    # ensure the proper headers are present
+    missing_headers = verify_headers(LDS_HEADERS, worksheet_values)
+    if missing_headers:
+        # print and write out the list of missing headers from the missing_headers list of strings
+        print(f"Missing headers in location {location_id}, sheet {lds_link}, headers: {missing_headers}")
+        DB.retailer_updated(location_id, 2)
+        raise PermanentJobError(f"Missing headers {missing_headers}")
 
-        contact_id_batch, location_id_batch = create_batch(location_id, worksheet_values, headers_mapping)
+    # load the location's contacts once so every row resolves in memory
+    contact_index = ContactIndex.from_db(DB, location_id)
+    contact_id_batch, location_id_batch = create_batch(location_id, worksheet_values, headers_mapping, contact_index)
+    ROWS_PROCESSED.inc(len(contact_id_batch), kind="lds_rows", location=location_id)
 
-        update_location_contact_ids(location_id_batch, contact_id_batch, lead_data_sheet, location_id)
-        DB.retailer_updated(location_id, 1)
+    # a failed write leaves the retailer as not updated so it is retried
+    if not update_location_contact_ids(location_id_batch, contact_id_batch, lead_data_sheet, location_id):
+        raise LeadDataSheetError(f"Could not write contact ids to lead data sheet {lds_link}")
+    DB.retailer_updated(location_id, 1)
     return True
 
 
@@ -212,9 +482,23 @@ def verify_headers(required_headers, worksheet_values):
     return missing
 
 
-def create_batch(location_id, worksheet_values, headers_mapping):
+def skip_for_missing_headers(location_id, lds_link, worksheet_values):
+    """
+    Prints and logs the LDS_HEADERS missing from a lead data sheet and returns True when any are,
+    the read-only passes skip such sheets instead of aborting on them
+    """
+    missing_headers = verify_headers(LDS_HEADERS, worksheet_values)
+    if missing_headers:
+        message = f"Missing headers in location {location_id}, sheet {lds_link}, headers: {missing_headers}"
+        print(message)
+        logging.warning(message)
+    return bool(missing_headers)
+
+
+def create_batch(location_id, worksheet_values, headers_mapping, contact_index=None):
     """
     Use: the function takes in an unstructured list of lists and returns a list of lists with the necessary information to correlate contacts to the correct row in the lead data sheet
+    contact_index: optional ContactIndex of the location, rows are matched with a query per row without it
     """
     # iterate through every row and attempt to correlate a contact to the row
     contact_id_batch = []
@@ -222,24 +506,35 @@ def create_batch(location_id, worksheet_values, headers_mapping):
     for row in worksheet_values[1:]:
         # attempt to find records in the "rgm_contacts" table with matching phone numbers or emails, then try first and last name
 
-        phone_number = format_phone_number(row[headers_mapping["phone"]])
-        email = row[headers_mapping["email"]].lower() if row[headers_mapping["email"]] else None
-        first_name = (
-            row[headers_mapping["first name"]].lower().rstrip() if row[headers_mapping["first name"]] else None
+        # normalized the same way as the keys stored with every contact
+        phone_number, email, first_name, last_name = contact_match_keys(
+            row[headers_mapping["phone"]],
+            row[headers_mapping["email"]],
+            row[headers_mapping["first name"]],
+            row[headers_mapping["last name"]],
         )
-        last_name = row[headers_mapping["last name"]].lower().rstrip() if row[headers_mapping["last name"]] else None
 
         previous_contact_record = row[headers_mapping["contact id"]]
         previous_location_record = row[headers_mapping["location id"]]
 
-        contact_record = DB.attempt_contact_retrieval(phone_number, email, first_name, last_name, location_id)
-
         # check if there is already a contact id in the row
         if previous_contact_record and previous_location_record:
             contact_id_batch.append(previous_contact_record)
             location_id_batch.append(previous_location_record)
             continue
 
+        if contact_index is not None:
+            contact_record = contact_index.lookup(phone_number, email, first_name, last_name)
+        else:
+            contact_record = DB.attempt_contact_retrieval(phone_number, email, first_name, last_name, location_id)
+
+        # names with typos only get compared against the contacts in their name block
+        if not contact_record and MatchConfig.FUZZY_NAMES:
+            if contact_index is not None:
+                contact_record = contact_index.fuzzy_lookup(first_name, last_name)
+            else:
+                contact_record = DB.attempt_fuzzy_name_retrieval(first_name, last_name, location_id)
+
         # if there is a contact record, append the contact id and location id to the batch
         if contact_record:
             query_contact_id = contact_record[0]
@@ -254,78 +549,69 @@ def create_batch(location_id, worksheet_values, headers_mapping):
     return contact_id_batch, location_id_batch
 
 
-def format_phone_number(phone_number):
-    """
-    Convert phone numbers with the following format "(910) 733-9541" and "18647878082" to "+19107339541"
-    """
-    if phone_number == "":
-        return ""
-    if phone_number[0] == "(":
-        return "+1" + "".join([c for c in phone_number if c.isdigit()])
-    if len(phone_number) == 11:
-        return "+" + phone_number
-    return None
-
-
 def update_location_contact_ids(location_id_batch, contact_id_batch, lds_sheet, location_id):
     """
     Use: Take in a list of contact ids and a list of location ids and updates the columns in the lead data sheet with the correct contact ids
+    Returns False when the write failed, including when Sheets kept throttling after every retry
     """
 
-    # map the headers
-    headers_mapping = {header.lower().rstrip(): index for index, header in enumerate(lds_sheet.get_all_values()[0])}
+    # map the headers to their columns in the sheet
+    headers_mapping = lds_sheet.headers_mapping()
 
     # determine which column contact and location ids are in
     contact_id_column = headers_mapping["contact id"]
     location_id_column = headers_mapping["location id"]
 
-    # generate the ranges for contact_id_column and location_id_column
-    contact_id_range = f"{chr(65 + contact_id_column)}2:{chr(65 + contact_id_column)}{len(contact_id_batch) + 1}"
-    location_id_range = f"{chr(65 + location_id_column)}2:{chr(65 + location_id_column)}{len(location_id_batch) + 1}"
-
-    # update the contact id column
+    # write only the contact and location id cells that changed
     try:
-        lds_sheet.batch_update(
-            [
-                {
-                    "range": contact_id_range,
-                    "values": [[contact_id] for contact_id in contact_id_batch],
-                },
-                {
-                    "range": location_id_range,
-                    "values": [[location_id] for location_id in location_id_batch],
-                },
-            ]
-        )
+        cells = lds_sheet.update_columns({contact_id_column: contact_id_batch, location_id_column: location_id_batch})
     except APIError as e:
-        code = e.args[0]["code"]
-        status = e.args[0]["status"]
-        if code == 429 and status == "RESOURCE_EXHAUSTED":
-            print("API Error: RESOURCE_EXHAUSTED sleeping for 100 seconds")
-            sleep(100)
-        else:
-            print(f"Error: {e} Location ID: {location_id}")
-            return True
-    print(f"Location {location_id} updated")
+        print(f"Error: {e} Location ID: {location_id}")
+        return False
+    print(f"Location {location_id} updated, {cells} cells written")
     return True
 
 
-def open_lds(google_client, lds_link, location_id):
+def open_lds(google_client, lds_link, location_id, headers=None):
+    """
+    Opens the first worksheet of the lead data sheet and reads its values.
+    google_client: a gspread client or a SheetSession, pass the run's SheetSession so the sheet is opened once
+    headers: when given only these columns are read and the values are a compact grid of just those columns,
+        with the normalized header names as the first row, see CachedWorksheet.get_projected_values
+    Returns (CachedWorksheet, values), or (False, None) when the sheet cannot be opened.
+    Failures are recorded in LDS_BREAKER and sheets whose breaker is open are skipped without calling Sheets.
+    """
+    if not LDS_BREAKER.allow(lds_link):
+        print(f"Skipping lead data sheet {lds_link} until its cooldown expires      Location ID: {location_id}")
+        return False, None
     try:
-        lead_data_sheet = google_client.open_by_url(lds_link).get_worksheet(index=0)
-        worksheet_values = lead_data_sheet.get_all_values()
+        lead_data_sheet = sheet_session(google_client).open(lds_link)
+        if headers:
+            worksheet_values = lead_data_sheet.get_projected_values(headers)
+        else:
+            worksheet_values = lead_data_sheet.get_all_values()
     except APIError as e:
         code = e.args[0]["code"]
         status = e.args[0]["status"]
-        if code == 429 and status == "RESOURCE_EXHAUSTED":
-            print("API Error: RESOURCE_EXHAUSTED sleeping for 100 seconds")
-            sleep(100)
-            return open_lds(google_client, lds_link, location_id)
-        elif code == 403 and status == "PERMISSION_DENIED":
-            return False
+        if code == 403 and status == "PERMISSION_DENIED":
+            LDS_BREAKER.record_failure(lds_link, "permission_denied", str(e))
+            return False, None
         else:
             print(f"Error: {e}      Location ID: {location_id}")
-            return False
+            # a quota spike or a Sheets outage isn't the sheet's fault, the job retries it instead
+            error_class = classify_status(code)
+            if error_class:
+                LDS_BREAKER.record_failure(lds_link, error_class, str(e))
+            return False, None
+    except SpreadsheetNotFound as e:
+        print(f"Lead data sheet not found: {lds_link}      Location ID: {location_id}")
+        LDS_BREAKER.record_failure(lds_link, "not_found", str(e) or "SpreadsheetNotFound")
+        return False, None
+    except NoValidUrlKeyFound as e:
+        print(f"Invalid lead data sheet link: {lds_link}      Location ID: {location_id}")
+        LDS_BREAKER.record_failure(lds_link, "invalid_url", str(e) or "NoValidUrlKeyFound")
+        return False, None
+    LDS_BREAKER.record_success(lds_link)
     return lead_data_sheet, worksheet_values
 
 
@@ -337,12 +623,15 @@ def write_missing_contact_location_id(google_client):
     Location ID: {locationId}, LDS Link: {lds_link}
         Row: {row}, Contact First Name: {first_name}, Contact Last Name: {last_name}
     """
+    google_client = sheet_session(google_client)
     retailers = DB.fetch_all_records("rgm_retailers")
     for row in retailers:
         total_missing = ""
-        lds_sheet, worksheet_values = open_lds(google_client, row[1], row[0])
+        lds_sheet, worksheet_values = open_lds(google_client, row[1], row[0], headers=LDS_HEADERS)
 
-        if not lds_sheet:
+        # the pass reads every sheet once, nothing needs to stay cached after it
+        google_client.release(row[1])
+        if not lds_sheet or skip_for_missing_headers(row[0], row[1], worksheet_values):
             continue
 
         missing_contacts = determine_missing_contacts(worksheet_values)
@@ -366,32 +655,8 @@ def determine_missing_contacts(worksheet_values):
     Returns list of lists with the following structure
     [[row, first_name, last_name], [row, first_name, last_name]]
     """
-    # create a mapping of the headers
-    headers_mapping = {header.lower().rstrip(): index for index, header in enumerate(worksheet_values[0])}
-
-    for index, row in enumerate(worksheet_values[1:], start=1):
-        # if the row doesn't have a value for "phone", "email", "first name", or "last name", skip
-        empty = True
-        for headers in ["phone", "email", "first name", "last name"]:
-            if row[headers_mapping[headers]] != "":
-                empty = False
-
-        if empty:
-            continue
-
-        contact_id = row[headers_mapping["contact id"]]
-        location_id = row[headers_mapping["location id"]]
-        first_name = row[headers_mapping["first name"]] if row[headers_mapping["first name"]] else ""
-        last_name = row[headers_mapping["last name"]] if row[headers_mapping["last name"]] else ""
-
-        # if test in the name or last name or the first and last name is "john" and "smith", skip
-        if "test" in first_name.lower() or "test" in last_name.lower():
-            continue
-        if first_name.lower() == "john" and last_name.lower() == "smith":
-            continue
-        if not contact_id and not location_id:
-            yield [index, first_name, last_name]
-    return None
+    _, rows = analyze_missing_contacts(worksheet_values)
+    return rows
 
 
 def count_missing_contact_location_id(google_client):
@@ -402,11 +667,14 @@ def count_missing_contact_location_id(google_client):
     Location ID: {locationId}, LDS Link: {lds_link}
         Row: {row}, Contact First Name: {first_name}, Contact Last Name: {last_name}
     """
+    google_client = sheet_session(google_client)
     retailers = DB.fetch_all_records("rgm_retailers")
     for row in retailers:
-        lds_sheet, worksheet_values = open_lds(google_client, row[1], row[0])
+        lds_sheet, worksheet_values = open_lds(google_client, row[1], row[0], headers=LDS_HEADERS)
 
-        if not lds_sheet:
+        # the pass reads every sheet once, nothing needs to stay cached after it
+        google_client.release(row[1])
+        if not lds_sheet or skip_for_missing_headers(row[0], row[1], worksheet_values):
             continue
 
         total_missing = f"Location ID: {row[0]}, LDS Link: {row[1]}\n"
@@ -423,48 +691,40 @@ def count_missing_contact_location_id(google_client):
 
 def count_missing_contacts(worksheet_values):
     """
-    Runs through worksheet values and returns a list of lists of missing contacts
-    Returns list of lists with the following structure
-    [[row, first_name, last_name], [row, first_name, last_name]]
+    Runs through worksheet values and returns the number of rows missing contact and location IDs
     """
-    # create a mapping of the headers
-    headers_mapping = {header.lower().rstrip(): index for index, header in enumerate(worksheet_values[0])}
-    count = 0
-    for index, row in enumerate(worksheet_values[1:], start=1):
-        # if the row doesn't have a value for "phone", "email", "first name", or "last name", skip
-        empty = True
-        for headers in ["phone", "email", "first name", "last name"]:
-            if row[headers_mapping[headers]] != "":
-                empty = False
-
-        if empty:
-            continue
+    count, _ = analyze_missing_contacts(worksheet_values)
+    return count
 
-        contact_id = row[headers_mapping["contact id"]]
-        location_id = row[headers_mapping["location id"]]
-        first_name = row[headers_mapping["first name"]] if row[headers_mapping["first name"]] else ""
-        last_name = row[headers_mapping["last name"]] if row[headers_mapping["last name"]] else ""
 
-        # if test in the name or last name or the first and last name is "john" and "smith", skip
-        if "test" in first_name.lower() or "test" in last_name.lower():
-            continue
-        if first_name.lower() == "john" and last_name.lower() == "smith":
-            continue
-        if not contact_id and not location_id:
-            count += 1
-    return count
+def missing_contacts_report_for_retailers(google_client):
+    """
+    Reads the lds_link of every retailer in the rgm_retailers table and returns one DataFrame of every row
+    missing contact and location IDs, see analysis.missing_contacts_report
+    """
+    google_client = sheet_session(google_client)
+
+    def sheets():
+        for row in DB.fetch_all_records("rgm_retailers"):
+            lds_sheet, worksheet_values = open_lds(google_client, row[1], row[0], headers=LDS_HEADERS)
+            # the report copies the columns it needs, the sheet isn't read again
+            google_client.release(row[1])
+            if lds_sheet and not skip_for_missing_headers(row[0], row[1], worksheet_values):
+                yield row[0], row[1], worksheet_values
 
+    return missing_contacts_report(sheets())
 
-import requests
+
+# pipelines of one location downloaded at the same time, requests are still paced by the ghl_v1 rate limiter
+PIPELINE_FETCH_WORKERS = 4
 
 
 def get_opportunities(access_token, pipeline_id):
-    headers = {"Authorization": "Bearer {}".format(access_token)}
-    base_url = f"https://rest.gohighlevel.com/v1/pipelines/{pipeline_id}/opportunities?limit=100"
+    base_url = f"{REST_V1_URL}/pipelines/{pipeline_id}/opportunities?limit=100"
     opportunities = []
 
     while base_url:
-        response = requests.get(base_url, headers=headers)
+        response = GHL_CLIENT.get(base_url, access_token=access_token)
 
         if response.status_code == 200:
             data = response.json()
@@ -478,71 +738,115 @@ def get_opportunities(access_token, pipeline_id):
     return opportunities
 
 
+def get_location_opportunities(access_token, pipelines, max_workers=PIPELINE_FETCH_WORKERS):
+    """
+    Downloads the opportunities of every pipeline concurrently and returns them as one list in pipeline order
+    """
+    if not pipelines:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pipelines)))) as executor:
+        pipeline_opportunities = executor.map(
+            lambda pipeline: get_opportunities(access_token, pipeline["id"]),
+            pipelines,
+        )
+        # flatten the list of lists
+        return [item for sublist in pipeline_opportunities for item in sublist]
+
+
 def get_location_pipelines_from_ghl(access_token):
     """
     Uses the first version of the gohighlevel api to get pipelines
     """
 
-    url = "https://rest.gohighlevel.com/v1/pipelines/"
+    url = f"{REST_V1_URL}/pipelines/"
 
-    payload = {}
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = GHL_CLIENT.get(url, access_token=access_token)
 
     return response.json()["pipelines"]
 
 
-def write_opportunity_data_to_sheets(lds_sheet, opportunities):
+def index_opportunities_by_contact(opportunities, pipeline_priority=None):
     """
-    Batch updates a google sheet to update the opportunity data
+    Maps each contact id to a single opportunity.
+    When a contact has several opportunities the one in the highest priority pipeline wins
+    (earlier in pipeline_priority, pipelines not listed come last), then the most recently
+    updated one (updatedAt, falling back to createdAt), then the first one in list order.
     """
-    lds_values = lds_sheet.get_all_values()
-    headers_mapping = {header.lower().rstrip(): index for index, header in enumerate(lds_values[0])}
+    priority = {pipeline_id: rank for rank, pipeline_id in enumerate(pipeline_priority or [])}
 
-    batch_update = []
-    for row in lds_values[1:]:
-        contact_id = row[headers_mapping.get("contact id", "")]  # Handle missing header
+    def sort_key(opportunity):
+        rank = priority.get(opportunity.get("pipelineId"), len(priority))
+        return rank, opportunity.get("updatedAt") or opportunity.get("createdAt") or ""
+
+    by_contact = {}
+    for opportunity in opportunities:
+        contact_id = (opportunity.get("contact") or {}).get("id")
         if not contact_id:
-            batch_update.append([""])
-        else:
-            updated = False  # Track if an update is made for this row
-            for opportunity in opportunities:
-                if (
-                    "contact" in opportunity
-                    and "id" in opportunity["contact"]
-                    and opportunity["contact"]["id"] == contact_id
-                ):
-                    batch_update.append([opportunity.get("id", "")])
-                    updated = True
-                    break
-            if not updated:
-                batch_update.append([""])
-    if "opportunity id" not in headers_mapping:
-        opportunity_index = headers_mapping["processed"] + 1
-        # use the header to figure out which column to update
-        opportunity_id_range = (
-            f"{chr(65 + opportunity_index-1)}2:{chr(65 + opportunity_index-1)}{len(batch_update) + 1}"
-        )
-        lds_sheet.insert_cols(values=[["Opportunity ID"]], col=opportunity_index)
-    else:
-        opportunity_id_range = f"{chr(65 + headers_mapping['opportunity id'])}2:{chr(65 + headers_mapping['opportunity id'])}{len(batch_update) + 1}"
-    lds_sheet.batch_update(
-        [
-            {
-                "range": opportunity_id_range,  # Update the range to a single column
-                "values": batch_update,
-            },
-        ]
+            continue
+        current = by_contact.get(contact_id)
+        if current is None:
+            by_contact[contact_id] = opportunity
+            continue
+        rank, updated_at = sort_key(opportunity)
+        current_rank, current_updated_at = sort_key(current)
+        if rank < current_rank or (rank == current_rank and updated_at > current_updated_at):
+            by_contact[contact_id] = opportunity
+    return by_contact
+
+
+def write_opportunity_data_to_sheets(lds_sheet, opportunities, pipeline_priority=None):
+    """
+    Batch updates a google sheet to update the opportunity data
+    See index_opportunities_by_contact for which opportunity is written for contacts with several
+    """
+    headers_mapping = lds_sheet.headers_mapping()
+    contact_id_column = headers_mapping["contact id"]
+    opportunity_id_column = headers_mapping.get("opportunity id")
+
+    # only the contact id and opportunity id columns are read
+    columns = lds_sheet.get_columns(
+        [column for column in (contact_id_column, opportunity_id_column) if column is not None]
     )
+    contact_ids = columns[contact_id_column]
+    # cover every row that currently holds an opportunity id so stale ids get cleared
+    row_count = max(len(column) for column in columns.values())
+
+    opportunities_by_contact = index_opportunities_by_contact(opportunities, pipeline_priority)
+
+    opportunity_ids = []
+    for row_index in range(row_count):
+        contact_id = contact_ids[row_index] if row_index < len(contact_ids) else ""
+        opportunity = opportunities_by_contact.get(contact_id) if contact_id else None
+        opportunity_ids.append(opportunity.get("id", "") if opportunity else "")
+    if opportunity_id_column is None:
+        # insert the new column where the processed column is, shifting processed to the right
+        opportunity_id_column = headers_mapping["processed"]
+        lds_sheet.insert_cols(values=[["Opportunity ID"]], col=opportunity_id_column + 1)
+
+    # write only the opportunity id cells that changed
+    lds_sheet.update_columns({opportunity_id_column: opportunity_ids})
 
     return True
 
 
-def update_lds_opportunities(google_client=None):
+def update_lds_opportunities(
+    google_client=None,
+    max_workers=JobConfig.WORKERS,
+    resume=True,
+    shard_index=JobConfig.SHARD_INDEX,
+    shard_count=JobConfig.SHARD_COUNT,
+    run_key=JobConfig.RUN_KEY,
+):
+    """
+    Writes the opportunity IDs into the lead data sheet of every GoHighLevel location with a retailer
+    in this process's shard. Each location is a "lds_opportunities" job in rgm_jobs, a ClickUp task is created
+    for the ones that still fail after every retry. Processes sharing a run_key (JOB_RUN_KEY) share the run.
+    Returns the job summary, see JobEngine.run
+    """
     if not google_client:
         google_client = gspread.service_account_from_dict(GoogConfig.CREDENTIALS)
-    mds_data = google_client.open_by_key(GoogConfig.MDS_SHEET_ID).get_worksheet(index=0).get_all_values()
+    mds_spreadsheet = SHEETS_LIMITER.call(google_client.open_by_key, GoogConfig.MDS_SHEET_ID)
+    mds_data = SHEETS_LIMITER.call(SHEETS_LIMITER.call(mds_spreadsheet.get_worksheet, 0).get_all_values)
 
     DB.create_retailers_table()
     insert_sheets_retailer_data(mds_data)
@@ -551,20 +855,37 @@ def update_lds_opportunities(google_client=None):
     access_token = GoHighLevelConfig.AGENCY_ACCESS_TOKEN
     gohighlevel_locations = get_agency_locations_gohighlevel(access_token)
 
+    # open and read every lead data sheet at most once for the run
+    sheets = sheet_session(google_client)
+
     # run through the gohighlevel locations, if there is an mds_link in the rgm_retailers table for the locationID, update the lead data sheet
+    jobs = {}
     for location in gohighlevel_locations:
-        location_key = location["apiKey"]
-        location_id = location["id"]
-        mds_link = DB.fetch_single_column("rgm_retailers", "lds_link", "locationId", location_id)
-        if not mds_link:
+        if not in_shard(location["id"], shard_index, shard_count):
             continue
-        try:
-            update_lds_with_opportunities(google_client, location_id, location_key, mds_link[0])
-        except Exception as e:
-            # prepare to create a clickup task
-            create_clickup_task(location_id, mds_link[0])
+        mds_link = DB.fetch_single_column("rgm_retailers", "lds_link", "locationId", location["id"])
+        if mds_link:
+            jobs[location["id"]] = (location["apiKey"], mds_link[0])
+
+    engine = JobEngine(
+        DB,
+        sharded_run_type("lds_opportunities", shard_index, shard_count),
+        lambda location_id: update_lds_with_opportunities(sheets, location_id, *jobs[location_id]),
+        max_workers=max_workers,
+        # flag the retailer and prepare to create a clickup task once the location is given up on
+        on_failure=lambda location_id, error: lds_opportunities_failed(location_id, jobs[location_id][1]),
+    )
+    DB.start_writer()
+    try:
+        return engine.run(list(jobs), resume=resume, run_key=run_key)
+    finally:
+        DB.stop_writer()
 
-    return True
+
+def lds_opportunities_failed(location_id, mds_link):
+    """on_failure of the lds_opportunities jobs, attempts that are still retried leave the retailer's status alone"""
+    DB.retailer_updated(location_id, 2)
+    create_clickup_task(location_id, mds_link)
 
 
 def create_clickup_task(location_id, mds_link):
@@ -574,23 +895,33 @@ def create_clickup_task(location_id, mds_link):
     parent_id = "8678qh5nd"
     assignees = [57084868]
     OPERATIONS = List(id=ClickUpConfig.OPERATIONS_LIST_ID)
-    OPERATIONS.create_task(
-        values={"name": title, "description": description, "assignees": assignees, "parent": parent_id}
+    CLICKUP_LIMITER.call(
+        OPERATIONS.create_task,
+        values={"name": title, "description": description, "assignees": assignees, "parent": parent_id},
     )
     return True
 
 
 def update_lds_with_opportunities(google_client, location_id, location_key, mds_link):
-    # get pipelines for the location
-    pipelines = get_location_pipelines_from_ghl(location_key)
+    """
+    Writes the location's opportunity IDs into its lead data sheet. The sheet is opened before anything is
+    downloaded from GHL, so a sheet that can't be opened or is skipped by its circuit breaker costs no GHL quota.
+    Raises LeadDataSheetError when the sheet can't be opened, PermanentJobError when its breaker is open.
+    """
+    try:
+        lds_sheet, _ = open_lds(google_client, mds_link, location_id, headers=["contact id", "opportunity id"])
+        if not lds_sheet:
+            # retrying a sheet whose circuit breaker is open would only be skipped again
+            if LDS_BREAKER.is_open(mds_link):
+                raise PermanentJobError(f"Lead data sheet {mds_link} is skipped until its cooldown expires")
+            raise LeadDataSheetError(f"Could not open lead data sheet {mds_link}")
 
-    # get opportunities for each pipeline
-    opportunities = [get_opportunities(location_key, pipeline["id"]) for pipeline in pipelines]
+        # get pipelines for the location
+        pipelines = get_location_pipelines_from_ghl(location_key)
 
-    # flatten the list of lists
-    opportunities = [item for sublist in opportunities for item in sublist]
-    try:
-        lds_sheet, _ = open_lds(google_client, mds_link, location_id)
+        # get opportunities for every pipeline at once
+        opportunities = get_location_opportunities(location_key, pipelines)
+        ROWS_PROCESSED.inc(len(opportunities), kind="opportunities", location=location_id)
 
         # write the opportunity data to the lead data sheet
         write_opportunity_data_to_sheets(lds_sheet, opportunities)
@@ -604,16 +935,14 @@ def update_lds_with_opportunities(google_client, location_id, location_key, mds_
         error_message = f"Error updating Opps for Location: {location_id} LDS: {mds_link} Error: {e}"
         logging.error(error_message)
         print(error_message)
-        DB.retailer_updated(location_id, 2)
-        return True
+        # let the job engine retry the location, lds_opportunities_failed flags it once it is given up on
+        raise
+    return True
 
 
 def get_agency_locations_gohighlevel(agency_access_token):
-    url = "https://rest.gohighlevel.com/v1/locations/"
-
-    payload = {}
-    headers = {"Authorization": f"Bearer {agency_access_token}"}
+    url = f"{REST_V1_URL}/locations/"
 
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = GHL_CLIENT.get(url, access_token=agency_access_token)
     verify_response(response.json())
     return response.json()["locations"]